@@ -1,5 +1,6 @@
 """DataStore implementation that stores files in a local directory."""
 
+import errno
 import os
 import shutil
 
@@ -31,9 +32,13 @@ class LocalDataStore(DataStore):
 
     def get_stream(self, name):
         path, version = self._parse_name(name)
-        if not os.path.exists(path):
+        try:
+            stream = open(path, 'rb')
+        except IOError as e:
+            if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+                raise
             raise FiletrackerError("File not found: " + path)
-        return open(path, 'rb'), versioned_name(name, _file_version(path))
+        return stream, versioned_name(name, int(os.fstat(stream.fileno()).st_mtime))
 
     def get_file(self, name, filename):
         # Use hardlinks to avoid unnecessary copying.
@@ -44,9 +49,10 @@ class LocalDataStore(DataStore):
 
     def exists(self, name):
         path, version = self._parse_name(name)
-        if not os.path.exists(path):
+        st = _stat_or_none(path)
+        if st is None:
             return False
-        if version is not None and _file_version(path) != version:
+        if version is not None and int(st.st_mtime) != version:
             return False
         return True
 
@@ -94,28 +100,111 @@ def _save_stream(path, stream, version=None):
     dir = os.path.dirname(path)
     if dir:
         mkdir(dir)
-    if os.path.exists(path) and version is not None and _file_version(path) >= version:
+    # Both stats are reused below, instead of checking each path again.
+    st = _stat_or_none(path)
+    if version is not None and st is not None and int(st.st_mtime) >= version:
         return version
-    if hasattr(stream, 'name') and os.path.exists(stream.name):
+    src_st = _stat_or_none(stream.name) if hasattr(stream, 'name') else None
+    if src_st is not None:
         try:
-            if not os.path.samefile(stream.name, path):
-                if os.path.exists(path):
+            if st is None or not os.path.samestat(src_st, st):
+                if st is not None:
                     os.unlink(path)
                 os.link(stream.name, path)
-            return _file_version(path)
+            # A hard link shares the modification time of the source.
+            return int(src_st.st_mtime)
         except OSError:
             pass
-    dest = open(path, 'wb')
-    shutil.copyfileobj(stream, dest)
-    dest.close()
+    with open(path, 'wb') as dest:
+        _copy_to_file(stream, dest)
     if version is not None:
         os.utime(path, (version, version))
+        return version
     return _file_version(path)
 
 
+# Size of a single copy_file_range() / sendfile() call.
+_COPY_CHUNK_SIZE = 16 * 1024 * 1024
+
+
+def _copy_file_range(src_fd, dest_fd, offset):
+    return os.copy_file_range(src_fd, dest_fd, _COPY_CHUNK_SIZE, offset)
+
+
+def _sendfile(src_fd, dest_fd, offset):
+    return os.sendfile(dest_fd, src_fd, offset, _COPY_CHUNK_SIZE)
+
+
+# Ways of copying data in the kernel, from the most efficient one.
+_KERNEL_COPIES = [
+    copy
+    for name, copy in [
+        ('copy_file_range', _copy_file_range),
+        ('sendfile', _sendfile),
+    ]
+    if hasattr(os, name)
+]
+
+
+def _copy_to_file(stream, dest):
+    """Copies the rest of ``stream`` to a newly opened file ``dest``.
+
+    If ``stream`` is a regular file too (e.g. when hard linking it failed,
+    because it's on another file system), the data is copied by the kernel,
+    without passing through Python buffers.
+    """
+    try:
+        src_fd = stream.fileno()
+        offset = stream.tell()
+    except (AttributeError, IOError, ValueError):
+        src_fd = None
+
+    if src_fd is not None:
+        dest_fd = dest.fileno()
+        for copy in _KERNEL_COPIES:
+            copied = 0
+            try:
+                while True:
+                    n = copy(src_fd, dest_fd, offset + copied)
+                    if n == 0:
+                        break
+                    copied += n
+            except OSError as e:
+                # Not supported for this pair of files (e.g. between file
+                # systems on older kernels), try the next way from scratch.
+                if e.errno not in _KERNEL_COPY_UNSUPPORTED:
+                    raise
+                os.ftruncate(dest_fd, 0)
+                os.lseek(dest_fd, 0, os.SEEK_SET)
+                continue
+            stream.seek(offset + copied)
+            return
+
+    shutil.copyfileobj(stream, dest)
+
+
+_KERNEL_COPY_UNSUPPORTED = (
+    errno.EXDEV,
+    errno.EINVAL,
+    errno.ENOSYS,
+    errno.EOPNOTSUPP,
+    errno.ESPIPE,
+)
+
+
 def _file_version(path):
     return int(os.stat(path).st_mtime)
 
 
 def _file_size(path):
     return int(os.stat(path).st_size)
+
+
+def _stat_or_none(path):
+    """Returns ``os.stat()`` of ``path``, or None if it doesn't exist."""
+    try:
+        return os.stat(path)
+    except OSError as e:
+        if e.errno in (errno.ENOENT, errno.ENOTDIR):
+            return None
+        raise
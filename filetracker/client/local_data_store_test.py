@@ -12,7 +12,7 @@ import six
 
 from filetracker.client import FiletrackerError
 from filetracker.client.data_store import DataStore
-from filetracker.client.local_data_store import LocalDataStore
+from filetracker.client.local_data_store import LocalDataStore, _copy_to_file
 
 
 class LocalDataStoreTest(unittest.TestCase):
@@ -50,6 +50,21 @@ class LocalDataStoreTest(unittest.TestCase):
         with open(dest_file_path) as f:
             self.assertEqual(f.read(), 'hello')
 
+    def test_copy_to_file_should_copy_rest_of_file(self):
+        src_file_path = os.path.join(self.dir_path, 'temp.txt')
+        dest_file_path = os.path.join(self.dir_path, 'temp2.txt')
+
+        with open(src_file_path, 'wb') as f:
+            f.write(b'hello world')
+
+        with open(src_file_path, 'rb') as src, open(dest_file_path, 'wb') as dest:
+            src.read(6)
+            _copy_to_file(src, dest)
+            self.assertEqual(src.read(), b'')
+
+        with open(dest_file_path, 'rb') as f:
+            self.assertEqual(f.read(), b'world')
+
     def test_exists_should_work_as_expected(self):
         self.assertFalse(self.store.exists('/foo.txt'))
 
@@ -17,13 +17,18 @@ from six.moves.urllib.parse import urlencode
 
 from filetracker.client import FiletrackerError
 from filetracker.client.data_store import DataStore
-from filetracker.utils import split_name, versioned_name, check_name, file_digest
+from filetracker.utils import (
+    split_name,
+    versioned_name,
+    check_name,
+    digest_and_copy,
+)
 
 logger = logging.getLogger('filetracker')
 
 
 # Protocol versions supported by this client.
-_SUPPORTED_VERSIONS = {1, 2}
+_SUPPORTED_VERSIONS = {1, 2, 3}
 
 # Capabilities defined by the protocol:
 
@@ -40,6 +45,13 @@ SERVER_ACCEPTS_SHA256_DIGEST = 3
 # The server supports deleting files
 SERVER_ACCEPTS_DELETE = 4
 
+# The server can store a file by reusing a blob it already has
+# ('Only-If-Blob-Exists' header), without receiving the contents.
+# Knowing a digest and size is then enough to link any stored file, which
+# is acceptable only because the server has no authentication anyway:
+# every client can read all files.
+SERVER_ACCEPTS_BLOB_REUSE = 5
+
 _PROTOCOL_CAPABILITIES = {
     1: [
         SERVER_REQUIRES_VERSION_HEADER,
@@ -49,8 +61,18 @@ _PROTOCOL_CAPABILITIES = {
         SERVER_ACCEPTS_SHA256_DIGEST,
         SERVER_ACCEPTS_DELETE,
     ],
+    3: [
+        SERVER_ACCEPTS_GZIP,
+        SERVER_ACCEPTS_SHA256_DIGEST,
+        SERVER_ACCEPTS_DELETE,
+        SERVER_ACCEPTS_BLOB_REUSE,
+    ],
 }
 
+# Files smaller than this are uploaded right away: for them, an extra
+# request asking whether the server already has them isn't worth it.
+_BLOB_REUSE_MIN_SIZE = 64 * 1024
+
 
 def _verbose_http_errors(fn):
     @functools.wraps(fn)
@@ -114,9 +136,6 @@ class RemoteDataStore(DataStore):
 
         headers = {}
 
-        if compress_hint and self._has_capability(SERVER_ACCEPTS_SHA256_DIGEST):
-            headers['SHA256-Checksum'] = file_digest(filename)
-
         # Important detail: this upload is streaming.
         # http://docs.python-requests.org/en/latest/user/advanced/#streaming-uploads
 
@@ -135,17 +154,53 @@ class RemoteDataStore(DataStore):
                 #  and a temporary file seems to be a more suitable choice.
                 with tempfile.TemporaryFile() as tmp:
                     with gzip.GzipFile(fileobj=tmp, mode='wb') as gz:
-                        shutil.copyfileobj(f, gz)
-                    tmp.seek(0)
-                    headers['Content-Encoding'] = 'gzip'
-                    headers['Logical-Size'] = str(os.stat(filename).st_size)
-                    response = self._put_file(url, version, tmp, headers)
+                        if self._has_capability(SERVER_ACCEPTS_SHA256_DIGEST):
+                            # Hashed while compressing, to read the file once.
+                            headers['SHA256-Checksum'] = digest_and_copy(f, gz)
+                        else:
+                            shutil.copyfileobj(f, gz)
+                    logical_size = os.fstat(f.fileno()).st_size
+
+                    response = None
+                    if (
+                        'SHA256-Checksum' in headers
+                        and logical_size >= _BLOB_REUSE_MIN_SIZE
+                        and self._has_capability(SERVER_ACCEPTS_BLOB_REUSE)
+                    ):
+                        # The compressed contents are sent only if the
+                        # server doesn't have them yet.
+                        response = self._put_existing_blob(
+                            url, version, headers['SHA256-Checksum'], logical_size
+                        )
+                    if response is None:
+                        tmp.seek(0)
+                        headers['Content-Encoding'] = 'gzip'
+                        headers['Logical-Size'] = str(logical_size)
+                        response = self._put_file(url, version, tmp, headers)
             else:
                 response = self._put_file(url, version, f, headers)
 
         name, version = split_name(name)
         return versioned_name(name, self._parse_last_modified(response))
 
+    def _put_existing_blob(self, url, version, digest, logical_size):
+        """Asks the server to store the file using a blob it already has.
+
+        Returns the response, or None if the server doesn't have the blob
+        and the file has to be uploaded.
+        """
+        headers = {
+            'SHA256-Checksum': digest,
+            'Logical-Size': str(logical_size),
+            'Only-If-Blob-Exists': 'true',
+        }
+        url, headers = self._add_version_to_request(url, headers, version)
+        response = requests.put(url, data=b'', headers=headers)
+        if response.status_code == 412:
+            return None
+        response.raise_for_status()
+        return response
+
     def _put_file(self, url, version, f, headers):
         url, headers = self._add_version_to_request(url, headers, version)
         response = requests.put(url, data=f, headers=headers)
@@ -202,8 +257,8 @@ class RemoteDataStore(DataStore):
         response.raise_for_status()
 
         # Logical-Size is only sent by new servers that use
-        # compression and send 'Content-Encoding: gzip'
-        if response.headers.get('content-encoding', 'plain') == 'gzip':
+        # compression and send 'Content-Encoding: gzip' (or 'zstd')
+        if response.headers.get('content-encoding', 'plain') in ('gzip', 'zstd'):
             return int(response.headers.get('logical-size', 0))
         else:
             return int(response.headers.get('content-length', 0))
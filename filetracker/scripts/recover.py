@@ -5,25 +5,35 @@ from __future__ import division
 from __future__ import print_function
 
 import argparse
-import gzip
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
 import os
 import sys
 
 import six
 
 from filetracker.scripts import progress_bar
-from filetracker.servers.storage import FileStorage
+from filetracker.servers.storage import (
+    FileStorage,
+    link_metadata_key,
+    open_blob,
+    pack_blob_metadata,
+    pack_link_metadata,
+)
 from filetracker.servers.run import db_init
+from filetracker.utils import fadvise, file_digest
 
 _DESCRIPTION = """
 Restores storage consistency after failures.
 
 
 This script iterates over all existing links, removing broken ones and
-recalculating blob reference count from scratch, overwriting existing
-values in DB.
+recalculating blob reference count and link versions from scratch,
+overwriting existing values in DB.
 
 It also iterates over blobs and removes blobs that are not linked.
+Optionally, contents of the remaining blobs can be verified against
+their digests.
 
 WARNING: this script does not use or respect locks, so DO NOT run
 this while storage is being used by a filetracker server.
@@ -32,6 +42,9 @@ this while storage is being used by a filetracker server.
 # Value used for aligning printed action names
 _ACTION_LENGTH = 25
 
+# Number of DB writes grouped into a single transaction
+_DB_BATCH_SIZE = 1000
+
 
 def main(argv=None):
     parser = argparse.ArgumentParser(description=_DESCRIPTION)
@@ -49,11 +62,26 @@ def main(argv=None):
         help='if set, logical size of all blobs is recalculated '
         '(this may take a lot of time)',
     )
+    parser.add_argument(
+        '-v',
+        '--verify',
+        action='store_true',
+        help='if set, contents of all blobs are checked against their '
+        'digests (this may take a lot of time)',
+    )
+    parser.add_argument(
+        '-j',
+        '--jobs',
+        type=int,
+        default=None,
+        help='number of threads used for verifying blobs (default: number of CPUs)',
+    )
 
     args = parser.parse_args(argv)
     root = args.root
     silent = args.silent
     full = args.full
+    verify = args.verify
 
     ensure_storage_format(root)
     db_init(os.path.join(root, 'db'))
@@ -76,6 +104,7 @@ def main(argv=None):
     processed_links = 0
     broken_links = 0
     blob_links = {}
+    link_versions = {}
 
     with progress_bar.conditional(show=not silent, widgets=links_widgets) as bar:
         for cur_dir, _, files in os.walk(file_storage.links_dir):
@@ -101,13 +130,12 @@ def main(argv=None):
                     else:
                         digest = os.path.basename(blob_path)
                         blob_links[digest] = blob_links.get(digest, 0) + 1
+                        name = os.path.relpath(link_path, file_storage.links_dir)
+                        link_versions[name] = (os.lstat(link_path).st_mtime, digest)
 
                 processed_links += 1
                 bar.update(processed_links)
 
-    for digest, link_count in six.iteritems(blob_links):
-        db.put(digest.encode(), str(link_count).encode())
-
     blobs_widgets = [
         ' [',
         progress_bar.Timer(format='Time: %(elapsed)s'),
@@ -121,8 +149,12 @@ def main(argv=None):
 
     processed_blobs = 0
     broken_blobs = 0
+    blob_paths = []
+    logical_sizes = {}
 
-    with progress_bar.conditional(show=not silent, widgets=blobs_widgets) as bar:
+    with progress_bar.conditional(
+        show=not silent, widgets=blobs_widgets
+    ) as bar, _BatchWriter(file_storage) as writer:
         for cur_dir, _, files in os.walk(file_storage.blobs_dir):
             for blob_name in files:
                 if blob_name not in blob_links:
@@ -130,17 +162,44 @@ def main(argv=None):
                     broken_blobs += 1
                     continue
 
-                size_key = '{}:logical_size'.format(blob_name).encode()
-                if not db.has_key(size_key) or full:
-                    blob_path = os.path.join(cur_dir, blob_name)
-                    with gzip.open(blob_path, 'rb') as zf:
+                blob_path = os.path.join(cur_dir, blob_name)
+                blob_paths.append(blob_path)
+
+                digest_bytes = blob_name.encode()
+                metadata = file_storage._blob_metadata(digest_bytes)
+                logical_size = metadata[1] if metadata is not None else None
+                if logical_size is None or full:
+                    with _open_blob_once(blob_path) as zf:
                         logical_size = _read_stream_for_size(zf)
 
-                    db.put(size_key, str(logical_size).encode())
+                logical_sizes[blob_name] = logical_size
+                writer.put(
+                    digest_bytes,
+                    pack_blob_metadata(blob_links[blob_name], logical_size),
+                )
+                # Left by the format where the size had a key of its own.
+                size_key = '{}:logical_size'.format(blob_name).encode()
+                if db.has_key(size_key):
+                    writer.delete(size_key)
 
                 processed_blobs += 1
                 bar.update(processed_blobs)
 
+    with _BatchWriter(file_storage) as writer:
+        # Link mtimes are the source of truth for versions here, as links
+        # may have been changed without their DB metadata in a crash.
+        link_keys = set()
+        for name, (version, digest) in six.iteritems(link_versions):
+            link_key = link_metadata_key(name)
+            link_keys.add(link_key)
+            writer.put(
+                link_key, pack_link_metadata(version, digest, logical_sizes[digest])
+            )
+
+        for key in db.keys():
+            if key.endswith(b':version') and key not in link_keys:
+                writer.delete(key)
+
     if not silent:
         print(
             'Completed, {} broken links and {} stray blobs found.'.format(
@@ -148,6 +207,17 @@ def main(argv=None):
             )
         )
 
+    if verify:
+        corrupted_blobs = verify_blobs(blob_paths, workers=args.jobs)
+        if not silent:
+            for blob_path in corrupted_blobs:
+                print('Blob contents do not match its digest: {}'.format(blob_path))
+            print(
+                'Verified {} blobs, {} corrupted.'.format(
+                    len(blob_paths), len(corrupted_blobs)
+                )
+            )
+
 
 def ensure_storage_format(root_dir):
     """Checks if the directory looks like a filetracker storage.
@@ -167,14 +237,106 @@ def ensure_storage_format(root_dir):
         sys.exit(1)
 
 
-def _read_stream_for_size(stream, buf_size=65536):
+class _BatchWriter(object):
+    """Groups DB writes into transactions of up to ``batch_size`` writes.
+
+    Committing each write separately would flush the DB log every time,
+    which dominates the running time for storages with many blobs.
+    Should be used as a context manager, pending writes are committed
+    on exit.
+    """
+
+    def __init__(self, file_storage, batch_size=_DB_BATCH_SIZE):
+        self._file_storage = file_storage
+        self._batch_size = batch_size
+        self._pending = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, _exc_value, _traceback):
+        if exc_type is None:
+            self.flush()
+
+    def put(self, key, value):
+        self._pending.append((key, value))
+        if len(self._pending) >= self._batch_size:
+            self.flush()
+
+    def delete(self, key):
+        self.put(key, None)
+
+    def flush(self):
+        if not self._pending:
+            return
+        db = self._file_storage.db
+        with self._file_storage._db_transaction() as txn:
+            for key, value in self._pending:
+                if value is None:
+                    db.delete(key, txn=txn)
+                else:
+                    db.put(key, value, txn=txn)
+        self._pending = []
+
+
+def verify_blobs(blob_paths, workers=None):
+    """Checks if contents of blobs match the digests they are named after.
+
+    Blobs are checked in parallel by ``workers`` threads (by default one
+    per CPU). This scales with the number of threads, because both
+    decompression and hashing release the GIL.
+
+    Returns a list of paths to corrupted blobs.
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        digests = executor.map(_blob_digest, blob_paths)
+        return [
+            blob_path
+            for blob_path, digest in zip(blob_paths, digests)
+            if digest != os.path.basename(blob_path)
+        ]
+
+
+def _blob_digest(blob_path):
+    """Returns SHA256 digest of decompressed blob contents, or None if
+    the blob can't be decompressed."""
+    try:
+        with _open_blob_once(blob_path) as blob:
+            return file_digest(blob)
+    except Exception:
+        # Decompression errors differ between codecs,
+        # and any of them means that the blob is corrupted.
+        return None
+
+
+@contextlib.contextmanager
+def _open_blob_once(blob_path):
+    """Opens a blob for reading its contents once, from start to end.
+
+    Pages of the blob are dropped from the page cache afterwards, so that
+    scanning the whole storage doesn't evict files the server is using.
+    """
+    with open(blob_path, 'rb') as raw:
+        fadvise(raw, 'SEQUENTIAL')
+        try:
+            with open_blob(raw) as blob:
+                yield blob
+        finally:
+            fadvise(raw, 'DONTNEED')
+
+
+def _read_stream_for_size(stream, buf_size=128 * 1024):
     """Reads a stream discarding the data read and returns its size."""
     size = 0
+    buf = bytearray(buf_size)
     while True:
-        buf = stream.read(buf_size)
-        size += len(buf)
-        if not buf:
+        read_size = stream.readinto(buf)
+        if not read_size:
             break
+        size += read_size
     return size
 
 
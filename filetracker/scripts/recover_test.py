@@ -5,13 +5,14 @@ from __future__ import division
 from __future__ import print_function
 
 import gzip
+import hashlib
 import os
 import shutil
 import tempfile
 import unittest
 
 from filetracker.scripts import recover
-from filetracker.servers.storage import FileStorage
+from filetracker.servers.storage import FileStorage, pack_blob_metadata
 
 
 class RecoveryScriptTest(unittest.TestCase):
@@ -36,8 +37,7 @@ class RecoveryScriptTest(unittest.TestCase):
 
         storage = FileStorage(self.temp_dir)
 
-        self.assertEqual(storage.db.get(b'0000'), b'1')
-        self.assertEqual(storage.db.get(b'0000:logical_size'), b'5')
+        self.assertEqual(storage.db.get(b'0000'), pack_blob_metadata(1, 5))
 
     def test_should_remove_broken_links(self):
         _touch_hello_gz(os.path.join(self.temp_dir, 'blobs', '00', '0000'))
@@ -53,6 +53,23 @@ class RecoveryScriptTest(unittest.TestCase):
 
         self.assertFalse(os.path.islink(os.path.join(self.temp_dir, 'links', '0.txt')))
 
+    def test_should_recreate_link_versions(self):
+        _touch_hello_gz(os.path.join(self.temp_dir, 'blobs', '00', '0000'))
+
+        link_path = os.path.join(self.temp_dir, 'links', '0.txt')
+        os.symlink(os.path.join(self.temp_dir, 'blobs', '00', '0000'), link_path)
+        os.utime(link_path, (1, 1), follow_symlinks=False)
+
+        storage = FileStorage(self.temp_dir)
+        storage.db.put(b'1.txt:version', b'2')
+        del storage
+
+        recover.main([self.temp_dir, '-s'])
+
+        storage = FileStorage(self.temp_dir)
+        self.assertEqual(storage.stored_version('0.txt'), 1)
+        self.assertIsNone(storage.db.get(b'1.txt:version'))
+
     def test_should_remove_stray_blobs(self):
         _touch_hello_gz(os.path.join(self.temp_dir, 'blobs', '00', '0000'))
 
@@ -62,6 +79,19 @@ class RecoveryScriptTest(unittest.TestCase):
             os.path.exists(os.path.join(self.temp_dir, 'blobs', '00', '0000'))
         )
 
+    def test_verify_blobs_should_find_corrupted_blobs(self):
+        good_path = os.path.join(self.temp_dir, 'blobs', '00', _HELLO_DIGEST)
+        bad_path = os.path.join(self.temp_dir, 'blobs', '00', '0000')
+        _touch_hello_gz(good_path)
+        _touch_hello_gz(bad_path)
+
+        corrupted = recover.verify_blobs([good_path, bad_path], workers=2)
+
+        self.assertEqual(corrupted, [bad_path])
+
+
+_HELLO_DIGEST = hashlib.sha256(b'hello').hexdigest()
+
 
 def _touch_hello_gz(path):
     with gzip.open(path, 'wb') as zf:
@@ -3,6 +3,7 @@ from __future__ import division
 from __future__ import print_function
 
 import email.utils
+import errno
 import json
 import logging
 import os
@@ -11,7 +12,13 @@ import time
 from six.moves.urllib.parse import parse_qs
 
 from filetracker.servers import base
-from filetracker.servers.storage import FileStorage, FiletrackerFileNotFoundError
+from filetracker.servers.storage import (
+    FileStorage,
+    FiletrackerBlobNotFoundError,
+    FiletrackerFileNotFoundError,
+    blob_encoding,
+    open_blob,
+)
 
 
 logger = logging.getLogger(__name__)
@@ -25,7 +32,7 @@ class FiletrackerServer(base.Server):
     to ``filetracker.servers.run`` for more details.
     """
 
-    def __init__(self, dir=None):
+    def __init__(self, dir=None, blob_codec=None, db_nosync=None):
         if dir is None:
             if 'FILETRACKER_DIR' not in os.environ:
                 raise AssertionError(
@@ -34,7 +41,11 @@ class FiletrackerServer(base.Server):
                     "or passed via FILETRACKER_DIR environment variable."
                 )
             dir = os.environ['FILETRACKER_DIR']
-        self.storage = FileStorage(dir)
+        if blob_codec is None:
+            blob_codec = os.environ.get('FILETRACKER_BLOB_CODEC') or 'gzip'
+        if db_nosync is None:
+            db_nosync = os.environ.get('FILETRACKER_DB_NOSYNC') == '1'
+        self.storage = FileStorage(dir, blob_codec=blob_codec, db_nosync=db_nosync)
         self.dir = self.storage.links_dir
 
     def parse_query_params(self, environ):
@@ -61,6 +72,13 @@ class FiletrackerServer(base.Server):
 
         digest = environ.get('HTTP_SHA256_CHECKSUM', None)
         logical_size = environ.get('HTTP_LOGICAL_SIZE', None)
+        existing_blob_only = environ.get('HTTP_ONLY_IF_BLOB_EXISTS') == 'true'
+        if existing_blob_only and not (digest and logical_size):
+            raise base.HttpError(
+                '400 Bad Request',
+                '"Only-If-Blob-Exists" requires "SHA256-Checksum" '
+                'and "Logical-Size" headers',
+            )
 
         if compressed and digest and logical_size:
             logger.debug('Handling PUT %s.', path)
@@ -74,15 +92,19 @@ class FiletrackerServer(base.Server):
                 logical_size,
             )
 
-        version = self.storage.store(
-            name=path,
-            data=environ['wsgi.input'],
-            version=last_modified,
-            size=content_length,
-            compressed=compressed,
-            digest=digest,
-            logical_size=logical_size,
-        )
+        try:
+            version = self.storage.store(
+                name=path,
+                data=environ['wsgi.input'],
+                version=last_modified,
+                size=content_length,
+                compressed=compressed,
+                digest=digest,
+                logical_size=logical_size,
+                existing_blob_only=existing_blob_only,
+            )
+        except FiletrackerBlobNotFoundError:
+            raise base.HttpError('412 Precondition Failed', 'Blob not found')
         start_response(
             '200 OK',
             [
@@ -92,17 +114,21 @@ class FiletrackerServer(base.Server):
         )
         return []
 
-    def _file_headers(self, name):
-        link_st = os.lstat(os.path.join(self.dir, name))
-        blob_st = os.stat(os.path.join(self.dir, name))
-        logical_size = self.storage.logical_size(name)
-        return [
-            ('Content-Type', 'application/octet-stream'),
-            ('Content-Length', str(blob_st.st_size)),
-            ('Content-Encoding', 'gzip'),
-            ('Last-Modified', email.utils.formatdate(link_st.st_mtime)),
-            ('Logical-Size', str(logical_size)),
-        ]
+    def _file_headers(self, name, blob, encoding):
+        version, logical_size = self.storage.stored_version_and_size(name)
+        if version is None:
+            # Deleted after the blob was opened.
+            raise base.HttpError('404 Not Found', 'File "{}" not found'.format(name))
+        headers = [('Content-Type', 'application/octet-stream')]
+        if encoding is None:
+            headers.append(('Content-Length', str(logical_size)))
+        else:
+            blob_st = os.fstat(blob.fileno())
+            headers.append(('Content-Length', str(blob_st.st_size)))
+            headers.append(('Content-Encoding', encoding))
+        headers.append(('Last-Modified', email.utils.formatdate(version)))
+        headers.append(('Logical-Size', str(logical_size)))
+        return headers
 
     def handle_GET(self, environ, start_response):
         endpoint, path = base.get_endpoint_and_path(environ)
@@ -111,21 +137,84 @@ class FiletrackerServer(base.Server):
         elif endpoint == 'version':
             return self.handle_version(environ, start_response)
         elif endpoint == 'files':
+            byte_range = _parse_range(environ.get('HTTP_RANGE'))
+            if byte_range is not None:
+                return self._handle_range(path, byte_range, start_response)
+
             full_path = os.path.join(self.dir, path)
 
-            if not os.path.isfile(full_path):
+            # Opening the file is the existence check, everything else
+            # is read from the open file.
+            try:
+                blob = _open_without_atime(full_path)
+            except EnvironmentError as e:
+                if e.errno not in (errno.ENOENT, errno.ENOTDIR, errno.EISDIR):
+                    raise
                 raise base.HttpError(
                     '404 Not Found', 'File "{}" not found'.format(full_path)
                 )
 
-            start_response('200 OK', self._file_headers(path))
-            return _FileIterator(open(full_path, 'rb'))
+            try:
+                encoding = blob_encoding(blob)
+                if encoding == 'zstd' and not _accepts_encoding(environ, 'zstd'):
+                    # Clients only decode what they announce, and most
+                    # can't decode zstd, so they get the file decompressed.
+                    headers = self._file_headers(path, blob, None)
+                    body = _FileIterator(open_blob(blob), raw=blob)
+                else:
+                    headers = self._file_headers(path, blob, encoding)
+                    body = _FileIterator(blob)
+            except:
+                blob.close()
+                raise
+            start_response('200 OK', headers)
+            return body
         else:
             raise base.HttpError(
                 '400 Bad Request',
                 'Unknown endpoint "{}", expected "files" or "list"'.format(endpoint),
             )
 
+    def _handle_range(self, path, byte_range, start_response):
+        """Responds with a part of decompressed contents of a file."""
+        version, logical_size = self.storage.stored_version_and_size(path)
+        if version is None:
+            raise base.HttpError('404 Not Found', 'File "{}" not found'.format(path))
+
+        first, last = byte_range
+        if first is None:
+            # The last ``last`` bytes.
+            start = max(logical_size - last, 0)
+            end = logical_size
+        else:
+            start = first
+            end = logical_size if last is None else min(last + 1, logical_size)
+        if start >= end:
+            start_response(
+                '416 Range Not Satisfiable',
+                [('Content-Range', 'bytes */{}'.format(logical_size))],
+            )
+            return []
+
+        try:
+            body = self.storage.open_range(path, start, end)
+        except FiletrackerFileNotFoundError:
+            raise base.HttpError('404 Not Found', 'File "{}" not found'.format(path))
+        start_response(
+            '206 Partial Content',
+            [
+                ('Content-Type', 'application/octet-stream'),
+                ('Content-Length', str(end - start)),
+                (
+                    'Content-Range',
+                    'bytes {}-{}/{}'.format(start, end - 1, logical_size),
+                ),
+                ('Last-Modified', email.utils.formatdate(version)),
+                ('Logical-Size', str(logical_size)),
+            ],
+        )
+        return _FileIterator(body)
+
     def handle_DELETE(self, environ, start_response):
         endpoint, path = base.get_endpoint_and_path(environ)
         if endpoint != 'files':
@@ -173,7 +262,7 @@ class FiletrackerServer(base.Server):
     def handle_version(self, environ, start_response):
         start_response('200 OK', [('Content-Type', 'application/json')])
         response = {
-            'protocol_versions': [2],
+            'protocol_versions': [2, 3],
         }
         return [json.dumps(response).encode('utf8')]
 
@@ -181,9 +270,12 @@ class FiletrackerServer(base.Server):
 class _FileIterator(object):
     """File iterator that supports early closing."""
 
-    def __init__(self, fileobj, bufsize=65536):
+    def __init__(self, fileobj, bufsize=65536, raw=None):
         self.fileobj = fileobj
         self.bufsize = bufsize
+        # The file read by ``fileobj``, if closing ``fileobj`` doesn't
+        # close it.
+        self.raw = raw
 
     def __iter__(self):
         return self
@@ -196,12 +288,80 @@ class _FileIterator(object):
         if data:
             return data
         else:
-            self.fileobj.close()
+            self.close()
             raise StopIteration()
 
     def close(self):
         """Iterator becomes invalid after call to this method."""
         self.fileobj.close()
+        if self.raw is not None:
+            self.raw.close()
+
+
+# Not available on all platforms.
+_O_NOATIME = getattr(os, 'O_NOATIME', 0)
+
+
+def _open_without_atime(path):
+    """Opens a file for reading in binary mode, without updating its access
+    time if possible.
+
+    Blobs are read much more often than written, and their access times
+    are never used, so updating them would be a metadata write per read.
+    O_NOATIME is only allowed to the owner of the file.
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY | _O_NOATIME)
+    except OSError as e:
+        if e.errno != errno.EPERM or not _O_NOATIME:
+            raise
+        fd = os.open(path, os.O_RDONLY)
+    try:
+        # Fails with EISDIR for directories.
+        return os.fdopen(fd, 'rb')
+    except:
+        os.close(fd)
+        raise
+
+
+def _parse_range(header):
+    """Parses a 'Range' header with a single range of bytes.
+
+    Returns ``(first, last)`` byte positions, where ``first`` is None
+    for a range of the last ``last`` bytes, and ``last`` is None for
+    a range to the end. Returns None if the header is missing or can't be
+    served as a single range, in which case the whole file is sent.
+    """
+    if not header or not header.startswith('bytes='):
+        return None
+    first, sep, last = header[len('bytes=') :].strip().partition('-')
+    if not sep or not (first or last):
+        return None
+    try:
+        first = int(first) if first else None
+        last = int(last) if last else None
+    except ValueError:
+        # Also covers lists of ranges.
+        return None
+    if (first is not None and first < 0) or (last is not None and last < 0):
+        return None
+    if first is not None and last is not None and last < first:
+        return None
+    return first, last
+
+
+def _accepts_encoding(environ, encoding):
+    """Checks whether the request's 'Accept-Encoding' allows ``encoding``."""
+    qvalues = {}
+    for item in environ.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        coding, _, params = item.partition(';')
+        params = params.replace(' ', '')
+        try:
+            qvalue = float(params[2:]) if params.startswith('q=') else 1.0
+        except ValueError:
+            qvalue = 1.0
+        qvalues[coding.strip().lower()] = qvalue
+    return qvalues.get(encoding, qvalues.get('*', 0.0)) > 0
 
 
 def _list_files_iterator(root_dir, version_cutoff):
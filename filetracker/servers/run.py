@@ -30,9 +30,11 @@ import sys
 import tempfile
 
 import bsddb3
+import gevent
 
 from filetracker.servers.files import FiletrackerServer
 from filetracker.servers.migration import MigrationFiletrackerServer
+from filetracker.servers.storage import DB_CACHE_SIZE
 from filetracker.utils import mkdir
 
 
@@ -42,6 +44,9 @@ logger = logging.getLogger(__name__)
 # Clients may use this as a sensible default port to connect to.
 DEFAULT_PORT = 9999
 
+# How often workers check if the metadata DB should be checkpointed.
+_DB_CHECKPOINT_INTERVAL_S = 30
+
 _DEFAULT_LOG_CONFIG_JSON = """
 {
   "version": 1,
@@ -143,6 +148,25 @@ def main(args=None):
         help="Turns on migration mode "
         "and redirects requests to nonexistent files to the remote",
     )
+    parser.add_option(
+        '--blob-codec',
+        dest='blob_codec',
+        default='gzip',
+        type='choice',
+        choices=['gzip', 'zstd'],
+        help="Compression used for newly stored blobs (default: gzip). "
+        "zstd requires the zstandard package on the server; clients that "
+        "don't accept 'Content-Encoding: zstd' get such files decompressed",
+    )
+    parser.add_option(
+        '--db-nosync',
+        dest='db_nosync',
+        action='store_true',
+        default=False,
+        help="Don't flush metadata DB transactions to disk on commit. "
+        "Faster, but after a system crash the recovery script "
+        "(filetracker-recover) has to be run",
+    )
     parser.add_option(
         '--workers',
         dest='workers',
@@ -197,7 +221,9 @@ def main(args=None):
         |workers = {workers}
         |worker_class = 'gevent'
         |raw_env = ['FILETRACKER_DIR={filetracker_dir}',
-        |           'FILETRACKER_FALLBACK_URL={fallback_url}']
+        |           'FILETRACKER_FALLBACK_URL={fallback_url}',
+        |           'FILETRACKER_BLOB_CODEC={blob_codec}',
+        |           'FILETRACKER_DB_NOSYNC={db_nosync:d}']
         |timeout = 5*60
         |
         |logconfig_dict = {logconfig_dict}
@@ -214,6 +240,8 @@ def main(args=None):
             workers=options.workers,
             filetracker_dir=options.dir,
             fallback_url=options.fallback_url,
+            blob_codec=options.blob_codec,
+            db_nosync=options.db_nosync,
             logconfig_dict=repr(log_config),
         )
     )
@@ -255,6 +283,9 @@ def db_init(db_dir):
     logger.info('Attempting to create and/or initialize database.')
     mkdir(db_dir)
     db_env = bsddb3.db.DBEnv()
+    # The environment is recreated here, so this sets the cache size
+    # for all workers.
+    db_env.set_cachesize(0, DB_CACHE_SIZE, 1)
     db_env.open(
         db_dir,
         bsddb3.db.DB_CREATE
@@ -279,6 +310,7 @@ def gunicorn_entry(env, start_response):
     global filetracker_instance
     if filetracker_instance is None:
         filetracker_instance = FiletrackerServer()
+        _start_db_checkpoints(filetracker_instance.storage)
     return filetracker_instance(env, start_response)
 
 
@@ -289,8 +321,28 @@ def gunicorn_entry_migration(env, start_response):
         if not fallback:
             raise RuntimeError('Configuration error. Fallback url not set.')
         filetracker_instance = MigrationFiletrackerServer(redirect_url=fallback)
+        _start_db_checkpoints(filetracker_instance.storage)
     return filetracker_instance(env, start_response)
 
 
+def _start_db_checkpoints(storage):
+    """Periodically checkpoints the metadata DB in a background greenlet.
+
+    Without checkpoints, recovery on startup replays the whole DB log.
+    DB handles are not opened as free-threaded, so the checkpoint runs
+    in the worker's own thread.
+    """
+
+    def checkpoint_forever():
+        while True:
+            gevent.sleep(_DB_CHECKPOINT_INTERVAL_S)
+            try:
+                storage.checkpoint()
+            except Exception:
+                logger.exception('Checkpointing the metadata DB failed.')
+
+    gevent.spawn(checkpoint_forever)
+
+
 if __name__ == '__main__':
     main()
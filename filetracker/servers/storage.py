@@ -6,7 +6,9 @@ The storage strategy is as follows:
 - Stored files are grouped into directories by their first byte (two hex
   characters), referred to as 'prefix'.
 - To minimize disk usage, duplicate files are only stored once.
-- All blobs are stored compressed (gzip).
+- All blobs are stored compressed (gzip by default, zstd can be
+  enabled with the ``blob_codec`` setting). The codec of a blob is
+  recognized by its magic bytes, so blobs of both kinds may coexist.
 
 - A directory tree is maintanted with symlinks that mirror the logical
   file naming and hierarchy.
@@ -15,39 +17,87 @@ The storage strategy is as follows:
   modification time of the blob.
 
 - Accesses to links and blobs are protected by separate fcntl locks
-  to avoid concurrent modification.
+  to avoid concurrent modification. The locks are byte-range locks on
+  a single 'locks.bin' file, at offsets derived from hashes of the
+  link names and blob digests.
 
 - Additional metadata about blobs is stored in a BSDDB kv-store.
 - The metadata stored ATM is the symlink count and decompressed
-  ("logical") size.
+  ("logical") size of blobs (packed together under the blob digest),
+  and versions of links with digests and logical sizes of their blobs.
+  The version in the DB is authoritative; links without one fall back
+  to their mtime. Links are changed along with their DB metadata, in the
+  same transaction.
 """
 
 from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import collections
 import contextlib
-import email.utils
 import errno
 import fcntl
 import gevent
+import gevent.event
 import gzip
+import hashlib
+import itertools
 import logging
 import os
 import shutil
-import subprocess
+import struct
 import sys
 import tempfile
+import zlib
 
 import bsddb3
-import six
 
-from filetracker.utils import file_digest
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import indexed_gzip
+except ImportError:
+    indexed_gzip = None
+
+try:
+    from isal import igzip, isal_zlib
+except ImportError:
+    igzip = isal_zlib = None
+
+from filetracker.utils import fadvise, file_digest
 
 
 _LOCK_RETRIES = 20
 _LOCK_SLEEP_TIME_S = 1
 
+BLOB_CODECS = ('gzip', 'zstd')
+
+# Size of the BSDDB memory pool, set when the environment is created.
+# It should comfortably hold the whole metadata working set.
+DB_CACHE_SIZE = 64 * 1024 * 1024
+
+# The metadata hash table is sized for this many keys when created,
+# so that it doesn't have to grow (and split buckets) during heavy ingest.
+_DB_EXPECTED_KEYS = 4 * 1024 * 1024
+_DB_HASH_FILL_FACTOR = 40
+
+# A checkpoint is only made if this much was logged since the previous one,
+# or this many minutes have passed.
+_DB_CHECKPOINT_KBYTES = 10 * 1024
+_DB_CHECKPOINT_MINUTES = 5
+
+_ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+_ZSTD_LEVEL = 3
+
+# Gzip blobs with at least this many bytes of contents get a seek-point
+# index when they are stored (if indexed_gzip is available).
+_INDEXED_BLOB_MIN_SIZE = 16 * 1024 * 1024
+_SEEK_POINT_SPACING = 4 * 1024 * 1024
+
 
 logger = logging.getLogger(__name__)
 
@@ -56,6 +106,10 @@ class FiletrackerFileNotFoundError(Exception):
     pass
 
 
+class FiletrackerBlobNotFoundError(Exception):
+    pass
+
+
 class ConcurrentModificationError(Exception):
     """Raised after acquiring lock failed multiple times."""
 
@@ -67,20 +121,46 @@ class ConcurrentModificationError(Exception):
 class FileStorage(object):
     """Manages the whole file storage."""
 
-    def __init__(self, base_dir):
+    def __init__(self, base_dir, blob_codec='gzip', db_nosync=False):
+        """Opens (or creates) the storage in ``base_dir``.
+
+        If ``db_nosync`` is set, commits of metadata transactions are written
+        to the OS but not flushed to disk. This makes them much cheaper, but
+        transactions committed just before a system crash may be lost, and
+        the recovery script has to be run afterwards.
+        """
+        if blob_codec not in BLOB_CODECS:
+            raise ValueError('Unknown blob codec: {}'.format(blob_codec))
+        if blob_codec == 'zstd' and zstandard is None:
+            raise RuntimeError('zstd blob codec requires the zstandard package')
+
         self.base_dir = base_dir
+        self.blob_codec = blob_codec
         self.blobs_dir = os.path.join(base_dir, 'blobs')
         self.links_dir = os.path.join(base_dir, 'links')
-        self.locks_dir = os.path.join(base_dir, 'locks')
         self.db_dir = os.path.join(base_dir, 'db')
+        self.temp_dir = os.path.join(base_dir, 'tmp')
+        self.indexes_dir = os.path.join(base_dir, 'indexes')
+
+        os.makedirs(self.blobs_dir, exist_ok=True)
+        os.makedirs(self.links_dir, exist_ok=True)
+        os.makedirs(self.db_dir, exist_ok=True)
+        os.makedirs(self.temp_dir, exist_ok=True)
+        # indexes_dir is only created with the first seek-point index.
+        self._links_prefix = self.links_dir + '/'
+        self._blobs_prefix = self.blobs_dir + '/'
+        self._indexes_prefix = self.indexes_dir + '/'
 
-        _makedirs(self.blobs_dir)
-        _makedirs(self.links_dir)
-        _makedirs(self.locks_dir)
-        _makedirs(self.db_dir)
+        self.locks = _LockTable.open(os.path.join(base_dir, 'locks.bin'))
+
+        # There are only 256 blob prefixes, so after a while all of them
+        # are known to exist and creating blob directories is free.
+        self._blobs_dir_fd = os.open(self.blobs_dir, os.O_RDONLY | os.O_DIRECTORY)
+        self._blob_prefixes = set()
 
         # https://docs.oracle.com/cd/E17076_05/html/programmer_reference/transapp_env_open.html
         self.db_env = bsddb3.db.DBEnv()
+        self.db_env.set_cachesize(0, DB_CACHE_SIZE, 1)
         try:
             self.db_env.open(
                 self.db_dir,
@@ -96,16 +176,34 @@ class FileStorage(object):
                 'DB requires recovery! It should have run in .run.main...'
             )
 
+        if db_nosync:
+            self.db_env.set_flags(bsddb3.db.DB_TXN_WRITE_NOSYNC, 1)
+
         self.db = bsddb3.db.DB(self.db_env)
+        # These only take effect when the database is created.
+        self.db.set_h_nelem(_DB_EXPECTED_KEYS)
+        self.db.set_h_ffactor(_DB_HASH_FILL_FACTOR)
         self.db.open(
             'metadata',
             dbtype=bsddb3.db.DB_HASH,
             flags=bsddb3.db.DB_CREATE | bsddb3.db.DB_AUTO_COMMIT,
         )
 
+    def checkpoint(self):
+        """Checkpoints the metadata DB, if enough has been logged since
+        the last checkpoint.
+
+        Flushes changed DB pages and the log to disk, bounding both the work
+        done by recovery on the next start, and what can be lost in a crash
+        when ``db_nosync`` is set.
+        """
+        self.db_env.txn_checkpoint(_DB_CHECKPOINT_KBYTES, _DB_CHECKPOINT_MINUTES)
+
     def __del__(self):
         self.db.close()
         self.db_env.close()
+        self.locks.close()
+        os.close(self._blobs_dir_fd)
 
     def store(
         self,
@@ -116,6 +214,7 @@ class FileStorage(object):
         compressed=False,
         digest=None,
         logical_size=None,
+        existing_blob_only=False,
     ):
         """Adds a new file to the storage.
 
@@ -147,92 +246,141 @@ class FileStorage(object):
                 resources.
             logical_size: if ``data`` is gzip-compressed, this parameter
                 has to be set to decompressed file size.
+            existing_blob_only: if True, the file is only stored if a blob
+                with ``digest`` and ``logical_size`` already exists, and
+                ``data`` is never read. Otherwise
+                ``FiletrackerBlobNotFoundError`` is raised.
         """
-        with _exclusive_lock(self._lock_path('links', name)):
+        if existing_blob_only and (digest is None or logical_size is None):
+            raise ValueError('existing_blob_only requires digest and logical_size')
+
+        with self.locks.exclusive('links', name):
             logger.debug('Acquired lock to link for %s.', name)
-            link_path = self._link_path(name)
-            if _path_exists(link_path) and _file_version(link_path) > version:
+            # The link can't change while we hold the lock, so its state
+            # is only read once.
+            current_version, current_digest, current_size = self._link_metadata(name)
+            if current_version is not None and current_version > version:
                 logger.info(
                     'Tried to store older version of %s (%d < %d), ignoring.',
                     name,
                     version,
-                    _file_version(link_path),
+                    current_version,
                 )
-                return _file_version(link_path)
+                return current_version
 
             # data is managed by contents now, and shouldn't be used directly
-            with _InputStreamWrapper(data, size) as contents:
+            with _InputStreamWrapper(data, size, self.temp_dir) as contents:
                 if digest is None or logical_size is None:
-                    contents.save()
                     if compressed:
                         # This shouldn't occur if the request came from a proper
                         # filetracker client, so we don't care if it's slow.
                         logger.warning('Storing compressed stream without hints.')
-                        with gzip.open(contents.current_path, 'rb') as decompressed:
-                            digest = file_digest(decompressed)
-                        with gzip.open(contents.current_path, 'rb') as decompressed:
-                            logical_size = _read_stream_for_size(decompressed)
+                        contents.save()
+                        digest, logical_size = _gzip_digest_and_size(
+                            contents.current_path
+                        )
                     else:
-                        digest = file_digest(contents.current_path)
-                        logical_size = os.stat(contents.current_path).st_size
+                        # Hash and compress in one pass, then either link
+                        # the result as the blob or throw it away if it's
+                        # a duplicate.
+                        digest, logical_size = contents.compress(self.blob_codec)
+                        compressed = True
+
+                # Hints come straight from request headers.
+                logical_size = int(logical_size)
+
+                if current_version is not None:
+                    if current_digest is None:
+                        current_digest = self._read_link_digest(name)
+                    if current_digest == digest:
+                        # Same contents again, so replacing the link
+                        # would only change its version.
+                        logger.debug('Link %s already points to %s.', name, digest)
+                        if current_size is None:
+                            # Stored by an old version, without the size.
+                            current_size = (
+                                self._blob_logical_size(digest) or logical_size
+                            )
+                        self._set_link_version(name, version, digest, current_size)
+                        return version
 
                 blob_path = self._blob_path(digest)
 
-                with _exclusive_lock(self._lock_path('blobs', digest)):
-                    logger.debug('Acquired lock for blob %s.', digest)
-                    digest_bytes = digest.encode()
-
-                    with self._db_transaction() as txn:
-                        logger.debug('Started DB transaction (adding link).')
-                        link_count = int(self.db.get(digest_bytes, 0, txn=txn))
-                        new_count = str(link_count + 1).encode()
-                        self.db.put(digest_bytes, new_count, txn=txn)
-
+                # Built before taking the blob lock, as it takes a while.
+                seek_index_path = None
+                if compressed and self._needs_seek_index(digest, logical_size):
+                    contents.save()
+                    if blob_encoding(contents.current_path) == 'gzip':
+                        seek_index_path = self._build_seek_index(contents.current_path)
+
+                try:
+                    with self.locks.exclusive('blobs', digest):
+                        logger.debug('Acquired lock for blob %s.', digest)
+                        digest_bytes = digest.encode()
+
+                        # All changes to the link count of a blob are made
+                        # under its lock, so it can't change until we're done.
+                        metadata = self._blob_metadata(digest_bytes)
+                        if existing_blob_only and (
+                            metadata is None or metadata[1] not in (None, logical_size)
+                        ):
+                            raise FiletrackerBlobNotFoundError
+                        if metadata is None:
+                            link_count = 0
+                        else:
+                            link_count, stored_logical_size = metadata
+                            if stored_logical_size is not None:
+                                logical_size = stored_logical_size
+
+                        # Create a new blob if this isn't a duplicate.
+                        # It's done before counting the new link, so that an upload
+                        # failing midway leaves at most a stray blob, and never
+                        # a counted link to a missing one.
                         if link_count == 0:
+                            self._create_blob(
+                                contents,
+                                blob_path,
+                                compressed,
+                                logical_size,
+                                seek_index_path,
+                            )
+
+                        with self._db_transaction() as txn:
+                            logger.debug('Started DB transaction (adding link).')
+                            self._put_blob_metadata(
+                                digest_bytes, link_count + 1, logical_size, txn
+                            )
                             self.db.put(
-                                '{}:logical_size'.format(digest).encode(),
-                                str(logical_size).encode(),
+                                link_metadata_key(name),
+                                pack_link_metadata(version, digest, logical_size),
                                 txn=txn,
                             )
-                        logger.debug('Commiting DB transaction (adding link).')
+                            # The link is replaced before the transaction commits,
+                            # so that if it fails, neither the link nor the DB
+                            # change.
+                            self._replace_link(name, digest, version)
+                            logger.debug('Commiting DB transaction (adding link).')
+
+                        logger.debug('Committed DB transaction (adding link).')
+
+                    logger.debug('Released lock for blob %s.', digest)
+                finally:
+                    # Unless it was installed with a new blob.
+                    if seek_index_path is not None:
+                        _remove_if_exists(seek_index_path)
+
+            if current_version is not None:
+                # The replaced link no longer counts towards its blob.
+                # The lock of the new blob has to be released first,
+                # as two blob locks are never held at once.
+                logger.info('Overwrote existing link %s.', name)
+                self._release_blob(current_digest)
 
-                    logger.debug('Committed DB transaction (adding link).')
-
-                    # Create a new blob if this isn't a duplicate.
-                    if link_count == 0:
-                        logger.debug('Creating new blob.')
-                        _create_file_dirs(blob_path)
-
-                        if compressed:
-                            contents.save(blob_path)
-                        else:
-                            contents.save()
-                            with open(contents.current_path, 'rb') as raw, gzip.open(
-                                blob_path, 'wb'
-                            ) as blob:
-                                shutil.copyfileobj(raw, blob)
-
-                logger.debug('Released lock for blob %s.', digest)
-
-            if _path_exists(link_path):
-                # Lend the link lock to delete().
-                # Note that DB lock has to be released in advance, otherwise
-                # deadlock is possible in concurrent scenarios.
-                logger.info('Overwriting existing link %s.', name)
-                self.delete(name, version, _lock=False)
-
-            _create_file_dirs(link_path)
-            rel_blob_path = os.path.relpath(blob_path, os.path.dirname(link_path))
-            os.symlink(rel_blob_path, link_path)
-
-            logger.debug('Created link %s.', name)
-
-            lutime(link_path, version)
             return version
 
         logger.debug('Released lock for link %s.', name)
 
-    def delete(self, name, version, _lock=True):
+    def delete(self, name, version):
         """Removes a file from the storage.
 
         Args:
@@ -241,92 +389,326 @@ class FileStorage(object):
              version: file "version" that is meant to be deleted
                  If the file that is stored has newer version than provided,
                  it will not be deleted.
-             lock: whether or not to acquire locks
-                 This is for internal use only,
-                 normal users should always leave it set to True.
         Returns whether or not the file has been deleted.
         """
-        link_path = self._link_path(name)
-        if _lock:
-            file_lock = _exclusive_lock(self._lock_path('links', name))
-        else:
-            file_lock = _no_lock()
-        with file_lock:
-            logger.debug('Acquired or inherited lock for link %s.', name)
-            if not _path_exists(link_path):
+        with self.locks.exclusive('links', name):
+            logger.debug('Acquired lock for link %s.', name)
+            current_version, digest, _ = self._link_metadata(name)
+            if current_version is None:
                 raise FiletrackerFileNotFoundError
-            if _file_version(link_path) > version:
+            if current_version > version:
                 logger.info(
                     'Tried to delete newer version of %s (%d < %d), ignoring.',
                     name,
                     version,
-                    _file_version(link_path),
+                    current_version,
                 )
                 return False
 
-            digest = self._digest_for_link(name)
-
-            with _exclusive_lock(self._lock_path('blobs', digest)):
-                logger.debug('Acquired lock for blob %s.', digest)
-                should_delete_blob = False
-
-                with self._db_transaction() as txn:
-                    logger.debug('Started DB transaction (deleting link).')
-                    digest_bytes = digest.encode()
-                    link_count = self.db.get(digest_bytes, txn=txn)
-                    if link_count is None:
-                        raise RuntimeError("File exists but has no key in db")
-
-                    link_count = int(link_count)
-                    if link_count == 1:
-                        logger.debug('Deleting last link to blob %s.', digest)
-                        self.db.delete(digest_bytes, txn=txn)
-                        self.db.delete(
-                            '{}:logical_size'.format(digest).encode(), txn=txn
-                        )
-                        should_delete_blob = True
-                    else:
-                        new_count = str(link_count - 1).encode()
-                        self.db.put(digest_bytes, new_count, txn=txn)
-                    logger.debug('Committing DB transaction (deleting link).')
+            if digest is None:
+                digest = self._read_link_digest(name)
+            self._release_blob(digest, link_name=name)
 
-                logger.debug('Committed DB transaction (deleting link).')
+        logger.debug('Released lock for link %s.', name)
+        return True
 
-                os.unlink(link_path)
-                logger.debug('Deleted link %s.', name)
-                if should_delete_blob:
-                    os.unlink(self._blob_path(digest))
+    def _release_blob(self, digest, link_name=None):
+        """Decrements the link count of blob ``digest``, deleting the blob
+        along with its last link.
 
-            logger.debug('Released lock for blob %s.', digest)
+        If ``link_name`` is given, the link and its metadata are removed
+        in the same DB transaction.
+        """
+        with self.locks.exclusive('blobs', digest):
+            logger.debug('Acquired lock for blob %s.', digest)
+            should_delete_blob = False
+
+            with self._db_transaction() as txn:
+                logger.debug('Started DB transaction (deleting link).')
+                digest_bytes = digest.encode()
+                metadata = self._blob_metadata(digest_bytes, txn)
+                if metadata is None:
+                    raise RuntimeError("File exists but has no key in db")
+
+                link_count, logical_size = metadata
+                if link_count == 1:
+                    logger.debug('Deleting last link to blob %s.', digest)
+                    self.db.delete(digest_bytes, txn=txn)
+                    _delete_legacy_logical_size(self.db, digest_bytes, txn)
+                    should_delete_blob = True
+                else:
+                    self._put_blob_metadata(
+                        digest_bytes, link_count - 1, logical_size, txn
+                    )
 
-        logger.debug('Released (or gave back) lock for link %s.', name)
-        return True
+                if link_name is not None:
+                    link_key = link_metadata_key(link_name)
+                    if self.db.exists(link_key, txn=txn):
+                        self.db.delete(link_key, txn=txn)
+                    # Removed before the transaction commits, so that if it
+                    # fails, neither the link nor the DB change.
+                    os.unlink(self._link_path(link_name))
+                    logger.debug('Deleted link %s.', link_name)
+                logger.debug('Committing DB transaction (deleting link).')
+
+            logger.debug('Committed DB transaction (deleting link).')
+
+            if should_delete_blob:
+                os.unlink(self._blob_path(digest))
+                _remove_if_exists(self._index_path(digest))
+
+        logger.debug('Released lock for blob %s.', digest)
 
     def stored_version(self, name):
         """Returns the version of file `name` or None if it doesn't exist."""
-        link_path = self._link_path(name)
-        if not _path_exists(link_path):
-            return None
-        return _file_version(link_path)
+        return self._link_metadata(name)[0]
 
     def logical_size(self, name):
         """Returns the logical size (before compression) of file `name`."""
-        digest = self._digest_for_link(name)
-        logical_size = self.db.get('{}:logical_size'.format(digest).encode())
+        return self.stored_version_and_size(name)[1]
 
-        if logical_size:
-            return int(logical_size.decode())
+    def stored_version_and_size(self, name):
+        """Returns ``(version, logical_size)`` of file `name`.
+
+        Both are None if the file doesn't exist. Unless the file was stored
+        by an old version, both come from a single DB lookup.
+        """
+        version, digest, logical_size = self._link_metadata(name)
+        if version is None or logical_size is not None:
+            return version, logical_size
+
+        if digest is None:
+            try:
+                digest = self._read_link_digest(name)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                # Deleted in the meantime.
+                return None, None
+        metadata = self._blob_metadata(digest.encode())
+        if metadata is not None and metadata[1] is not None:
+            return version, metadata[1]
         else:
-            raise RuntimeError('Blob doesn\'t have :logical_size in DB: try recovering')
+            raise RuntimeError('Blob doesn\'t have logical size in DB: try recovering')
+
+    def open_range(self, name, start, end):
+        """Opens contents of file ``name`` for reading from ``start``
+        to ``end`` (exclusive).
+
+        Offsets refer to the decompressed contents. Returns a file-like
+        object positioned at ``start``, which reads at most up to ``end``.
+        Large gzip blobs have a seek-point index, built when they were
+        stored, so getting to ``start`` decompresses at most a few MiB.
+        Other blobs are decompressed from the beginning.
+        """
+        version, digest, _ = self._link_metadata(name)
+        if version is None:
+            raise FiletrackerFileNotFoundError
+        if digest is None:
+            digest = self._read_link_digest(name)
+
+        blob = self._open_blob_for_seeking(digest)
+        try:
+            # Decompresses everything up to start, so it's done in a thread,
+            # not to block other greenlets.
+            gevent.get_hub().threadpool.apply(blob.seek, (start,))
+        except:
+            blob.close()
+            raise
+        return _RangeReader(blob, max(end - start, 0))
+
+    def _open_blob_for_seeking(self, digest):
+        blob_path = self._blob_path(digest)
+        index_path = self._index_path(digest)
+        # The blob is opened and its index loaded under the blob lock, as
+        # deleting and storing again a blob with the same digest (possibly
+        # compressed differently) replaces both.
+        with self.locks.exclusive('blobs', digest):
+            if indexed_gzip is None or not os.path.exists(index_path):
+                return open_blob(blob_path)
+            blob = indexed_gzip.IndexedGzipFile(blob_path, spacing=_SEEK_POINT_SPACING)
+            try:
+                gevent.get_hub().threadpool.apply(blob.import_index, (index_path,))
+            except:
+                blob.close()
+                raise
+            return blob
+
+    def _needs_seek_index(self, digest, logical_size):
+        """Checks if a new blob should get a seek-point index.
+
+        Duplicates of existing blobs are not indexed again. This is checked
+        without the blob lock, so it may be wrong in rare races, which only
+        costs some work or a missing index.
+        """
+        return (
+            indexed_gzip is not None
+            and logical_size >= _INDEXED_BLOB_MIN_SIZE
+            and self._blob_metadata(digest.encode()) is None
+        )
+
+    def _build_seek_index(self, blob_path):
+        """Builds a seek-point index of gzip file ``blob_path``.
+
+        Returns the path of a temporary file with the index.
+        """
+        logger.debug('Building seek-point index of %s.', blob_path)
+        fd, index_path = tempfile.mkstemp(dir=self.temp_dir)
+        os.close(fd)
+        try:
+            # The whole file is decompressed, so it's done in a thread,
+            # not to block other greenlets.
+            gevent.get_hub().threadpool.apply(
+                _write_seek_index, (blob_path, index_path)
+            )
+        except:
+            _remove_if_exists(index_path)
+            raise
+        return index_path
+
+    def _link_metadata(self, name):
+        """Returns ``(version, digest, logical_size)`` of link ``name``.
+
+        All are None if the link doesn't exist. ``digest`` and
+        ``logical_size`` may be None if they're not known from the DB.
+        """
+        value = self.db.get(link_metadata_key(name))
+        if value is not None:
+            return _unpack_link_metadata(value)
+        # Links created before versions were kept in the DB
+        # (or not yet recovered) only have the version as their mtime.
+        link_st = _lstat_or_none(self._link_path(name))
+        if link_st is None:
+            return None, None, None
+        return link_st.st_mtime, None, None
+
+    def _set_link_version(self, name, version, digest, logical_size):
+        with self._db_transaction() as txn:
+            self.db.put(
+                link_metadata_key(name),
+                pack_link_metadata(version, digest, logical_size),
+                txn=txn,
+            )
+            lutime(self._link_path(name), version)
+
+    def _replace_link(self, name, digest, version):
+        """Atomically points link ``name`` to blob ``digest``.
+
+        The new link is created aside, with its modification time already
+        set to ``version``, and renamed over the old one, so that the name
+        never disappears or points to a wrong blob on the way.
+        """
+        link_path = self._link_path(name)
+        temp_link_path = '{}/link.{}.{}'.format(
+            self.temp_dir, os.getpid(), next(_temp_link_ids)
+        )
+        os.symlink(_link_target(name, digest), temp_link_path)
+        try:
+            lutime(temp_link_path, version)
+            try:
+                os.rename(temp_link_path, link_path)
+            except OSError as e:
+                # Most links are created in existing directories,
+                # so they are only created when needed.
+                if e.errno != errno.ENOENT:
+                    raise
+                _create_file_dirs(link_path)
+                os.rename(temp_link_path, link_path)
+        except:
+            _remove_if_exists(temp_link_path)
+            raise
+        logger.debug('Created link %s.', name)
+
+    def _blob_metadata(self, digest_bytes, txn=None):
+        """Returns ``(link_count, logical_size)`` of a blob, or None.
+
+        ``logical_size`` may be None for blobs stored by old versions
+        which didn't compute it.
+        """
+        value = self.db.get(digest_bytes, txn=txn)
+        if value is None:
+            return None
+        if len(value) == _BLOB_METADATA.size:
+            return _BLOB_METADATA.unpack(value)
+        # Before this format, the link count was stored as a decimal
+        # number, and the logical size under a key of its own.
+        logical_size = self.db.get(_logical_size_key(digest_bytes), txn=txn)
+        return int(value), int(logical_size) if logical_size else None
+
+    def _put_blob_metadata(self, digest_bytes, link_count, logical_size, txn):
+        if logical_size is None:
+            # Keep the old format until the recovery script computes the size.
+            self.db.put(digest_bytes, str(link_count).encode(), txn=txn)
+            return
+        # A leftover old-format logical size key is harmless: it's never
+        # read once the value is packed, and is cleaned up with the blob.
+        self.db.put(digest_bytes, pack_blob_metadata(link_count, logical_size), txn=txn)
+
+    def _blob_logical_size(self, digest):
+        metadata = self._blob_metadata(digest.encode())
+        if metadata is None or metadata[1] is None:
+            return 0
+        return metadata[1]
+
+    def _create_blob(
+        self, contents, blob_path, compressed, logical_size, seek_index_path=None
+    ):
+        """Writes contents of the uploaded file to a new blob.
+
+        Uncompressed contents are streamed directly into the blob writer,
+        without going through a temporary file if they haven't been
+        saved in one already. Large files are gzipped in parallel.
+
+        ``seek_index_path`` is a seek-point index of compressed ``contents``,
+        which is moved next to the blob.
+        """
+        logger.debug('Creating new blob.')
+        digest = os.path.basename(blob_path)
+        self._create_blob_dir(digest)
+        # An index left by a previous blob with the same digest may not match
+        # the new compressed stream.
+        index_path = self._index_path(digest)
+        _remove_if_exists(index_path)
+
+        if compressed:
+            contents.save(blob_path)
+            if seek_index_path is not None:
+                _create_file_dirs(index_path)
+                os.rename(seek_index_path, index_path)
+            return
+
+        try:
+            with _open_blob_writer(blob_path, self.blob_codec, logical_size) as blob:
+                contents.write_to(blob)
+        except Exception:
+            # Don't leave a truncated blob behind.
+            if os.path.exists(blob_path):
+                os.unlink(blob_path)
+            raise
+
+    def _create_blob_dir(self, digest):
+        prefix = digest[0:2]
+        if prefix in self._blob_prefixes:
+            return
+        try:
+            os.mkdir(prefix, dir_fd=self._blobs_dir_fd)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        self._blob_prefixes.add(prefix)
+
+    # Paths are built by concatenation, because os.path.join() is
+    # comparatively slow and these are called several times per request.
+    # Names never start with a slash.
 
     def _link_path(self, name):
-        return os.path.join(self.links_dir, name)
+        return self._links_prefix + name
 
     def _blob_path(self, digest):
-        return os.path.join(self.blobs_dir, digest[0:2], digest)
+        return '{}{}/{}'.format(self._blobs_prefix, digest[0:2], digest)
 
-    def _lock_path(self, *path_parts):
-        return os.path.join(self.locks_dir, *path_parts)
+    def _index_path(self, digest):
+        return '{}{}/{}'.format(self._indexes_prefix, digest[0:2], digest)
 
     @contextlib.contextmanager
     def _db_transaction(self):
@@ -340,21 +722,31 @@ class FileStorage(object):
             txn.commit()
 
     def _digest_for_link(self, name):
-        link = self._link_path(name)
-        blob_path = os.readlink(link)
-        digest = os.path.basename(blob_path)
+        digest = self._link_metadata(name)[1]
+        if digest is None:
+            digest = self._read_link_digest(name)
         return digest
 
+    def _read_link_digest(self, name):
+        return os.readlink(self._link_path(name)).rsplit('/', 1)[-1]
+
 
 class _InputStreamWrapper(object):
     """A wrapper for lazy reading and moving contents of 'wsgi.input'.
 
     Should be used as a context manager.
+
+    Where possible (Linux), temporary files are created unnamed with
+    ``O_TMPFILE``, so they never appear in a directory and vanish on their
+    own when closed, even if the process crashes. Moving such file to its
+    destination is a single ``linkat()`` call.
     """
 
-    def __init__(self, data, size):
+    def __init__(self, data, size, temp_dir=None):
         self._data = data
         self._size = size
+        self._temp_dir = temp_dir
+        self._temp_fd = None
         self.current_path = None
         self.saved_in_temp = False
 
@@ -363,7 +755,10 @@ class _InputStreamWrapper(object):
 
     def __exit__(self, _exc_type, _exc_value, _traceback):
         """Removes file if it was last saved as a temporary file."""
-        if self.saved_in_temp:
+        if self._temp_fd is not None:
+            os.close(self._temp_fd)
+            self._temp_fd = None
+        elif self.saved_in_temp:
             os.unlink(self.current_path)
 
     def save(self, new_path=None):
@@ -371,21 +766,112 @@ class _InputStreamWrapper(object):
 
         Args:
             new_path: path to move to, if None a temporary file is created.
+                Saving to a temporary file again is a no-op.
         """
-        self.saved_in_temp = new_path is None
         if new_path is None:
-            fd, new_path = tempfile.mkstemp()
-            os.close(fd)
-
-        if self.current_path:
+            if self.saved_in_temp:
+                return
+            self._save_in_temp()
+            return
+
+        if self._temp_fd is not None:
+            _link_unnamed_file(self._temp_fd, new_path)
+            os.close(self._temp_fd)
+            self._temp_fd = None
+        elif self.current_path:
             shutil.move(self.current_path, new_path)
         else:
             with open(new_path, 'wb') as dest:
                 _copy_stream(self._data, dest, self._size)
         self.current_path = new_path
+        self.saved_in_temp = False
 
+    def write_to(self, dest):
+        """Writes stream contents to ``dest`` file-like object.
 
-_BUFFER_SIZE = 64 * 1024
+        Data is copied from the file if it was saved, and directly from
+        the stream otherwise.
+        """
+        if self.current_path:
+            with open(self.current_path, 'rb') as src:
+                shutil.copyfileobj(src, dest)
+        else:
+            _copy_stream(self._data, dest, self._size)
+
+    def compress(self, codec):
+        """Saves stream contents compressed with ``codec`` in a temporary file.
+
+        The stream is read only once: it's hashed on the way to the
+        compressor. Returns a tuple ``(digest, size)`` of uncompressed
+        contents.
+        """
+        fd, temp_path = self._create_temp_file()
+        with open(fd, 'wb', closefd=self._temp_fd is None) as raw:
+            with _blob_writer(raw, codec, self._size) as blob:
+                hashing_blob = _HashingWriter(
+                    blob, threaded=self._size >= _PARALLEL_GZIP_MIN_SIZE
+                )
+                _copy_stream(self._data, hashing_blob, self._size)
+        self.current_path = temp_path
+        self.saved_in_temp = True
+        return hashing_blob.hexdigest(), hashing_blob.size
+
+    def _save_in_temp(self):
+        fd, temp_path = self._create_temp_file()
+        with open(fd, 'wb', closefd=self._temp_fd is None) as dest:
+            _copy_stream(self._data, dest, self._size)
+        self.current_path = temp_path
+        self.saved_in_temp = True
+
+    def _create_temp_file(self):
+        fd = _open_unnamed_temp_file(self._temp_dir)
+        if fd is not None:
+            self._temp_fd = fd
+            return fd, '/proc/self/fd/{}'.format(fd)
+        return tempfile.mkstemp(dir=self._temp_dir)
+
+
+# O_TMPFILE files can only be given a name through /proc.
+_USE_O_TMPFILE = hasattr(os, 'O_TMPFILE') and os.path.isdir('/proc/self/fd')
+
+
+def _link_unnamed_file(fd, path):
+    """Gives a name to a file opened with ``O_TMPFILE``."""
+    # Passing a directory fd makes os.link() use linkat() instead of link(),
+    # and only the former can follow the /proc magic link.
+    proc_fd = os.open('/proc/self/fd', os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        try:
+            os.link(str(fd), path, src_dir_fd=proc_fd, follow_symlinks=True)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            # Replace the existing file, like shutil.move() would.
+            os.unlink(path)
+            os.link(str(fd), path, src_dir_fd=proc_fd, follow_symlinks=True)
+    finally:
+        os.close(proc_fd)
+
+
+def _open_unnamed_temp_file(dir):
+    """Returns a descriptor of an unnamed file in ``dir``.
+
+    Returns None if such files are not supported by the OS
+    or the filesystem.
+    """
+    if not _USE_O_TMPFILE or dir is None:
+        return None
+    try:
+        return os.open(dir, os.O_TMPFILE | os.O_RDWR, 0o600)
+    except OSError as e:
+        if e.errno in (errno.EOPNOTSUPP, errno.EISDIR, errno.EINVAL):
+            return None
+        raise
+
+
+# Large enough for reading and writing the data to cost less than
+# interpreting the copy loop around them.
+_BUFFER_SIZE = 1024 * 1024
 
 
 def _copy_stream(src, dest, length=0):
@@ -397,6 +883,9 @@ def _copy_stream(src, dest, length=0):
     Yes, there are WSGI implementations which do not support EOFs, and
     believe me, you don't want to debug this.
 
+    If ``src`` supports ``readinto()``, a single buffer is reused for
+    the whole copy instead of allocating a new one for every chunk.
+
     Args:
         src: source file-like object
         dest: destination file-like object
@@ -404,101 +893,483 @@ def _copy_stream(src, dest, length=0):
             If not 0, exactly length bytes will be written.
             If 0, write will continue until EOF is encountered.
     """
-    if length == 0:
-        shutil.copyfileobj(src, dest)
-        return
+    buf = None
+    if hasattr(src, 'readinto'):
+        buf = memoryview(bytearray(_BUFFER_SIZE))
 
     bytes_left = length
-    while bytes_left > 0:
-        buf_size = min(_BUFFER_SIZE, bytes_left)
-        buf = src.read(buf_size)
-        dest.write(buf)
-        bytes_left -= buf_size
-
-
-def _read_stream_for_size(stream):
-    """Reads a stream discarding the data read and returns its size."""
-    size = 0
-    while True:
-        buf = stream.read(_BUFFER_SIZE)
-        size += len(buf)
-        if not buf:
+    while length == 0 or bytes_left > 0:
+        read_size = _BUFFER_SIZE if length == 0 else min(_BUFFER_SIZE, bytes_left)
+        if buf is not None:
+            chunk = buf[: src.readinto(buf[:read_size])]
+        else:
+            chunk = src.read(read_size)
+        if not chunk:
             break
-    return size
+        dest.write(chunk)
+        bytes_left -= len(chunk)
+
+
+@contextlib.contextmanager
+def _open_blob_writer(path, codec, size=0):
+    """Opens a new blob for writing, compressing it with ``codec``.
+
+    ``size`` is the expected length of uncompressed contents, if known.
+    """
+    with open(path, 'wb') as raw:
+        with _blob_writer(raw, codec, size) as blob:
+            yield blob
+
+
+@contextlib.contextmanager
+def _blob_writer(raw, codec, size=0):
+    """Compresses data written to it with ``codec`` into ``raw`` file.
+
+    ``raw`` is left open.
+    """
+    if codec == 'zstd':
+        compressor = zstandard.ZstdCompressor(level=_ZSTD_LEVEL)
+        with compressor.stream_writer(raw, closefd=False) as blob:
+            yield blob
+    else:
+        if size >= _PARALLEL_GZIP_MIN_SIZE:
+            blob = _ParallelGzipWriter(raw)
+        else:
+            blob = _GzipWriter(raw)
+        yield blob
+        blob.close()
+
+
+class _HashingWriter(object):
+    """Passes writes through to ``dest``, keeping their SHA256 and length.
+
+    With ``threaded`` set, the hash is updated in gevent's pool of native
+    threads (hashlib releases the GIL), overlapping with reading of the
+    next part of the stream instead of blocking the worker in between.
+    """
+
+    def __init__(self, dest, threaded=False):
+        self._dest = dest
+        self._hash = hashlib.sha256()
+        self.size = 0
+        self._threaded = threaded
+        self._buffer = bytearray()
+        self._pending = None
+
+    def write(self, data):
+        self.size += len(data)
+        if not self._threaded:
+            self._hash.update(data)
+        else:
+            self._buffer += data
+            if len(self._buffer) >= _THREADED_HASH_CHUNK_SIZE:
+                self._submit()
+        return self._dest.write(data)
+
+    def hexdigest(self):
+        if self._threaded:
+            self._submit()
+            self._pending.get()
+        return self._hash.hexdigest()
+
+    def _submit(self):
+        # SHA256 is sequential, so at most one update may run at a time.
+        if self._pending is not None:
+            self._pending.get()
+        chunk = bytes(self._buffer)
+        self._buffer = bytearray()
+        threadpool = gevent.get_hub().threadpool
+        self._pending = threadpool.spawn(self._hash.update, chunk)
+
+
+_THREADED_HASH_CHUNK_SIZE = 1024 * 1024
+
+
+# ISA-L's deflate (if installed) produces plain gzip streams, several times
+# faster than zlib. Its highest level compresses about as well as zlib's 6.
+if isal_zlib is not None:
+    _deflate = isal_zlib
+    _GZIP_LEVEL = isal_zlib.ISAL_BEST_COMPRESSION
+    _gzip = igzip
+else:
+    _deflate = zlib
+    _GZIP_LEVEL = 6
+    _gzip = gzip
+
+# Member header without file name and modification time (RFC 1952).
+_GZIP_HEADER = b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'
+
+
+# Data that doesn't compress (archives, images, ...) is recognized
+# by compressing a sample of it quickly. It is then written in stored
+# (level 0) deflate blocks, which is still a valid gzip stream, costs
+# almost no CPU, and only adds 5 bytes per 64 KiB.
+_INCOMPRESSIBLE_SAMPLE_SIZE = 64 * 1024
+_INCOMPRESSIBLE_RATIO = 0.97
+
+
+def _deflate_compressor(sample, wbits):
+    """Returns a compressobj suitable for data starting with ``sample``."""
+    if sample:
+        compressed_size = len(_deflate.compress(sample, 1))
+        if compressed_size >= _INCOMPRESSIBLE_RATIO * len(sample):
+            # ISA-L has no level that stores data as-is.
+            return zlib.compressobj(0, zlib.DEFLATED, wbits)
+    return _deflate.compressobj(_GZIP_LEVEL, _deflate.DEFLATED, wbits)
+
+
+class _GzipWriter(object):
+    """Writes a gzip stream with raw deflate, without ``gzip.GzipFile``.
+
+    The header is constant, and the checksum of the trailer is kept
+    up to date with ``crc32``, so each write is only a couple
+    of calls into zlib (or ISA-L).
+
+    The compression level is chosen after the first
+    ``_INCOMPRESSIBLE_SAMPLE_SIZE`` bytes, which are buffered until then.
+    """
+
+    def __init__(self, raw):
+        self._raw = raw
+        self._compressor = None
+        self._sample = bytearray()
+        self._crc = 0
+        self._size = 0
+        raw.write(_GZIP_HEADER)
+
+    def write(self, data):
+        self._crc = _deflate.crc32(data, self._crc)
+        self._size += len(data)
+        if self._compressor is not None:
+            self._raw.write(self._compressor.compress(data))
+        else:
+            self._sample += data
+            if len(self._sample) >= _INCOMPRESSIBLE_SAMPLE_SIZE:
+                self._start_compressing()
+        return len(data)
+
+    def close(self):
+        if self._compressor is None:
+            self._start_compressing()
+        self._raw.write(self._compressor.flush())
+        self._raw.write(struct.pack('<II', self._crc, self._size & 0xFFFFFFFF))
+
+    def _start_compressing(self):
+        sample = bytes(self._sample)
+        self._sample = None
+        self._compressor = _deflate_compressor(
+            sample[:_INCOMPRESSIBLE_SAMPLE_SIZE], -zlib.MAX_WBITS
+        )
+        self._raw.write(self._compressor.compress(sample))
+
+
+_PARALLEL_GZIP_MIN_SIZE = 16 * 1024 * 1024
+_PARALLEL_GZIP_CHUNK_SIZE = 4 * 1024 * 1024
+_PARALLEL_GZIP_JOBS = os.cpu_count() or 1
+
+
+def _gzip_member(chunk):
+    compressor = _deflate_compressor(
+        chunk[:_INCOMPRESSIBLE_SAMPLE_SIZE], 16 + zlib.MAX_WBITS
+    )
+    return compressor.compress(chunk) + compressor.flush()
+
+
+class _ParallelGzipWriter(object):
+    """Writes a multi-member gzip stream, compressing members in parallel.
+
+    Every ``_PARALLEL_GZIP_CHUNK_SIZE`` bytes of input become a separate
+    gzip member, compressed in gevent's pool of native threads (zlib
+    releases the GIL). Concatenated members form a valid gzip file, so
+    readers don't have to know how it was written.
+    """
+
+    def __init__(self, raw):
+        self._raw = raw
+        self._buffer = bytearray()
+        self._pending = collections.deque()
+        self._threadpool = gevent.get_hub().threadpool
+
+    def write(self, data):
+        self._buffer += data
+        while len(self._buffer) >= _PARALLEL_GZIP_CHUNK_SIZE:
+            chunk = bytes(self._buffer[:_PARALLEL_GZIP_CHUNK_SIZE])
+            del self._buffer[:_PARALLEL_GZIP_CHUNK_SIZE]
+            self._submit(chunk)
+        return len(data)
+
+    def close(self):
+        if self._buffer:
+            self._submit(bytes(self._buffer))
+            self._buffer = bytearray()
+        while self._pending:
+            self._raw.write(self._pending.popleft().get())
+
+    def _submit(self, chunk):
+        # Limit the number of chunks held in memory.
+        if len(self._pending) >= _PARALLEL_GZIP_JOBS:
+            self._raw.write(self._pending.popleft().get())
+        self._pending.append(self._threadpool.spawn(_gzip_member, chunk))
+
+
+def _write_seek_index(blob_path, index_path):
+    with indexed_gzip.IndexedGzipFile(blob_path, spacing=_SEEK_POINT_SPACING) as blob:
+        blob.build_full_index()
+        blob.export_index(index_path)
+
+
+class _RangeReader(object):
+    """Reads at most ``length`` bytes from a file, closing it when closed."""
+
+    def __init__(self, fileobj, length):
+        self._fileobj = fileobj
+        self._bytes_left = length
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, _exc_type, _exc_value, _traceback):
+        self.close()
+
+    def read(self, size=-1):
+        if size < 0 or size > self._bytes_left:
+            size = self._bytes_left
+        data = self._fileobj.read(size) if size else b''
+        self._bytes_left -= len(data)
+        return data
+
+    def close(self):
+        self._fileobj.close()
+
+
+def blob_encoding(blob):
+    """Returns the codec name ('gzip' or 'zstd') of a blob.
+
+    ``blob`` is either a path or a file opened in binary mode (whose
+    position is not changed).
+    The name is suitable for use as the value of 'Content-Encoding' header.
+    """
+    if hasattr(blob, 'fileno'):
+        magic = os.pread(blob.fileno(), len(_ZSTD_MAGIC), 0)
+    else:
+        with open(blob, 'rb') as f:
+            magic = f.read(len(_ZSTD_MAGIC))
+    if magic == _ZSTD_MAGIC:
+        return 'zstd'
+    return 'gzip'
+
+
+def open_blob(blob):
+    """Opens a blob for reading its decompressed contents.
+
+    ``blob`` is either a path or a file opened in binary mode, which is
+    left open when the returned reader is closed.
+    """
+    if blob_encoding(blob) == 'zstd':
+        if zstandard is None:
+            raise RuntimeError('Reading zstd blobs requires the zstandard package')
+        decompressor = zstandard.ZstdDecompressor()
+        if hasattr(blob, 'fileno'):
+            return decompressor.stream_reader(blob, closefd=False)
+        return decompressor.stream_reader(open(blob, 'rb'))
+    return _gzip.open(blob, 'rb')
+
+
+def _gzip_digest_and_size(path):
+    """Calculates SHA256 digest and size of decompressed contents of a gzip file.
+
+    Both are computed in a single decompression pass.
+    """
+    # GzipFile buffers reads on its own, so the underlying file doesn't need to.
+    with open(path, 'rb', buffering=0) as raw:
+        fadvise(raw, 'SEQUENTIAL')
+        with _gzip.GzipFile(fileobj=raw, mode='rb') as decompressed:
+            return file_digest(decompressed, return_size=True)
 
 
 def _create_file_dirs(file_path):
     """Creates directory tree to file if it doesn't exist."""
     dir_name = os.path.dirname(file_path)
-    _makedirs(dir_name)
+    os.makedirs(dir_name, exist_ok=True)
 
 
-def _path_exists(path):
-    """Checks if the path exists
-    - is a file, a directory or a symbolic link that may be broken."""
-    return os.path.exists(path) or os.path.islink(path)
+# Link count and logical size of a blob, stored under its digest.
+_BLOB_METADATA = struct.Struct('<QQ')
 
 
-def _file_version(path):
-    return os.lstat(path).st_mtime
+def pack_blob_metadata(link_count, logical_size):
+    """Returns the DB value describing a blob."""
+    return _BLOB_METADATA.pack(link_count, logical_size)
 
 
-@contextlib.contextmanager
-def _exclusive_lock(path):
-    """A simple wrapper for fcntl exclusive lock."""
-    _create_file_dirs(path)
-    fd = os.open(path, os.O_WRONLY | os.O_CREAT, 0o600)
+def _logical_size_key(digest_bytes):
+    return digest_bytes + b':logical_size'
 
-    try:
-        retries_left = _LOCK_RETRIES
-        success = False
 
-        while retries_left > 0:
-            # try to acquire the lock in a loop
-            # because gevent doesn't treat flock as IO,
-            # so waiting here without yielding would get the worker killed
-            try:
-                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
-                success = True
-                break
-            except IOError as e:
-                if e.errno in [errno.EAGAIN, errno.EWOULDBLOCK]:
-                    # This yields execution to other green threads.
-                    gevent.sleep(_LOCK_SLEEP_TIME_S)
-                    retries_left -= 1
-                else:
-                    raise
+def _delete_legacy_logical_size(db, digest_bytes, txn):
+    size_key = _logical_size_key(digest_bytes)
+    if db.exists(size_key, txn=txn):
+        db.delete(size_key, txn=txn)
 
-        if success:
-            yield
-        else:
-            raise ConcurrentModificationError(path)
-    finally:
-        if success:
-            fcntl.flock(fd, fcntl.LOCK_UN)
-        os.close(fd)
 
+def _link_target(name, digest):
+    """Returns the path of blob ``digest`` relative to the directory
+    of link ``name``.
+
+    Same as ``os.path.relpath()`` of the blob path, which is much slower,
+    as links/ and blobs/ are both directly in the storage directory.
+    """
+    depth = os.path.normpath(name).count('/') + 1
+    return '{}blobs/{}/{}'.format('../' * depth, digest[0:2], digest)
+
+
+def link_metadata_key(name):
+    """Returns the DB key of the metadata of link ``name``."""
+    return name.encode() + b':version'
+
+
+def pack_link_metadata(version, digest, logical_size):
+    """Returns the DB value describing a link.
+
+    It holds the version, and the digest and logical size of the blob
+    the link points to, so that serving the file takes a single lookup.
+    """
+    return '{} {} {}'.format(version, digest, logical_size).encode()
+
+
+def _unpack_link_metadata(value):
+    """Returns ``(version, digest, logical_size)`` from a link's DB value.
+
+    Values written by earlier versions may lack the digest or the size.
+    """
+    fields = value.split(b' ')
+    version = float(fields[0])
+    digest = fields[1].decode() if len(fields) > 1 and fields[1] else None
+    logical_size = int(fields[2]) if len(fields) > 2 else None
+    return version, digest, logical_size
+
+
+# Distinguishes temporary links created by a process.
+_temp_link_ids = itertools.count()
+
+
+def _remove_if_exists(path):
+    try:
+        os.unlink(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
 
-@contextlib.contextmanager
-def _no_lock():
-    """Does nothing, just runs the code within the `with` statement.
-    Used for conditional locking."""
-    yield
 
+def _lstat_or_none(path):
+    """Returns lstat() result for the path, or None if it doesn't exist.
 
-def _makedirs(path):
-    """A py2 wrapper for os.makedirs() that simulates exist_ok=True flag."""
+    Broken symbolic links are considered existing. The link's
+    modification time is the file "version".
+    """
     try:
-        os.makedirs(path)
+        return os.lstat(path)
     except OSError as e:
-        if e.errno != errno.EEXIST:
+        # ENOTDIR means that a file is in the way of a parent directory,
+        # as os.path.lexists() also assumes.
+        if e.errno in (errno.ENOENT, errno.ENOTDIR):
+            return None
+        raise
+
+
+# Lock slots are offsets in the locks file: the top bit selects
+# the namespace, and the remaining ones come from a hash of the key.
+_LOCK_NAMESPACES = {'links': 0, 'blobs': 1}
+_LOCK_KEY_BITS = 23
+
+
+class _LockTable(object):
+    """Exclusive locks on keys, kept as byte-range locks on a single file.
+
+    POSIX record locks only exclude other processes, so locks held by
+    greenlets of this process are additionally tracked in memory. Greenlets
+    waiting for those are woken up as soon as the lock is released, instead
+    of polling the file. Keys hashing to the same slot share a lock, which
+    is harmless, as no code path holds two locks from the same namespace
+    at once.
+
+    Record locks belong to the process, and closing any descriptor of
+    the file drops all of them, so there is one table per file in
+    a process, shared by all storages using it (see ``open``).
+    """
+
+    # Tables open in this process, by real paths of their files. Tables
+    # can't be told apart by the inode of a newly opened descriptor,
+    # as closing it would drop the locks held through the existing one.
+    _open_tables = {}
+
+    def __init__(self, path):
+        self._path = path
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        # Maps offsets of locks held by this process to events set on release.
+        self._held = {}
+        self._users = 0
+
+    @classmethod
+    def open(cls, path):
+        """Returns the table of this process for the locks file at ``path``.
+
+        Each call must be paired with a call to ``close``.
+        """
+        path = os.path.realpath(path)
+        table = cls._open_tables.get(path)
+        if table is None:
+            table = cls._open_tables[path] = cls(path)
+        table._users += 1
+        return table
+
+    def close(self):
+        """Closes the file once the table is no longer used by any storage."""
+        self._users -= 1
+        if self._users == 0:
+            del self._open_tables[self._path]
+            os.close(self._fd)
+
+    @contextlib.contextmanager
+    def exclusive(self, namespace, key):
+        offset = _lock_offset(namespace, key)
+        retries_left = _LOCK_RETRIES
+        while not self._try_lock(offset):
+            released = self._held.get(offset)
+            if released is not None and released.wait(_LOCK_SLEEP_TIME_S):
+                continue
+            # Waiting without yielding would block the whole worker,
+            # because gevent doesn't treat fcntl locks as IO.
+            retries_left -= 1
+            if retries_left == 0:
+                raise ConcurrentModificationError('{}/{}'.format(namespace, key))
+            if released is None:
+                gevent.sleep(_LOCK_SLEEP_TIME_S)
+
+        try:
+            yield
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, offset)
+            self._held.pop(offset).set()
+
+    def _try_lock(self, offset):
+        if offset in self._held:
+            return False
+        try:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, offset)
+        except IOError as e:
+            if e.errno in [errno.EACCES, errno.EAGAIN]:
+                return False
             raise
+        self._held[offset] = gevent.event.Event()
+        return True
+
+
+def _lock_offset(namespace, key):
+    key_hash = hashlib.blake2b(key.encode(), digest_size=3).digest()
+    slot = int.from_bytes(key_hash, 'little') & ((1 << _LOCK_KEY_BITS) - 1)
+    return (_LOCK_NAMESPACES[namespace] << _LOCK_KEY_BITS) | slot
 
 
 def lutime(path, time):
-    if six.PY2:
-        t = email.utils.formatdate(time)
-        if subprocess.call(['touch', '-c', '-h', '-d', t, path]) != 0:
-            raise RuntimeError
-    else:
-        os.utime(path, (time, time), follow_symlinks=False)
+    os.utime(path, (time, time), follow_symlinks=False)
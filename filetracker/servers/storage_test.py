@@ -9,12 +9,31 @@ import hashlib
 import os
 import shutil
 import tempfile
+import time
 import unittest
 
+import gevent
 from six import BytesIO
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import indexed_gzip
+except ImportError:
+    indexed_gzip = None
+
 from filetracker.servers.run import db_init
-from filetracker.servers.storage import FileStorage
+from filetracker.servers.storage import (
+    FileStorage,
+    FiletrackerBlobNotFoundError,
+    _lock_offset,
+    blob_encoding,
+    open_blob,
+    pack_blob_metadata,
+)
 
 
 class FileStorageTest(unittest.TestCase):
@@ -34,6 +53,25 @@ class FileStorageTest(unittest.TestCase):
         storage_path = os.path.join(self.temp_dir, 'links', 'hello.txt')
         with gzip.open(storage_path, 'rb') as f:
             self.assertEqual(f.read(), b'hello')
+        self.assertEqual(
+            os.path.basename(os.readlink(storage_path)),
+            hashlib.sha256(b'hello').hexdigest(),
+        )
+        self.assertEqual(storage.logical_size('hello.txt'), 5)
+
+    def test_store_should_link_nested_names_to_blobs(self):
+        storage = FileStorage(self.temp_dir)
+
+        storage.store('a/b/hello.txt', BytesIO(b'hello'), version=1)
+
+        storage_path = os.path.join(self.temp_dir, 'links', 'a', 'b', 'hello.txt')
+        digest = hashlib.sha256(b'hello').hexdigest()
+        self.assertEqual(
+            os.readlink(storage_path),
+            os.path.relpath(storage._blob_path(digest), os.path.dirname(storage_path)),
+        )
+        with gzip.open(storage_path, 'rb') as f:
+            self.assertEqual(f.read(), b'hello')
 
     def test_store_should_respect_given_data_size(self):
         storage = FileStorage(self.temp_dir)
@@ -61,6 +99,71 @@ class FileStorageTest(unittest.TestCase):
         with gzip.open(storage_path, 'rb') as f:
             self.assertEqual(f.read(), b'hello')
 
+    def test_store_should_not_leave_temporary_files(self):
+        storage = FileStorage(self.temp_dir)
+
+        storage.store('hello.txt', BytesIO(b'hello'), version=1)
+        storage.store('world.txt', BytesIO(b'hello'), version=1)
+
+        self.assertEqual(os.listdir(storage.temp_dir), [])
+
+    def test_store_should_compute_hints_for_compressed_file(self):
+        storage = FileStorage(self.temp_dir)
+        gz_data = BytesIO()
+
+        with gzip.GzipFile(fileobj=gz_data, mode='wb') as dst:
+            dst.write(b'hello')
+
+        gz_data.seek(0)
+
+        storage.store('hello.txt', gz_data, version=1, compressed=True)
+
+        storage_path = os.path.join(self.temp_dir, 'links', 'hello.txt')
+        self.assertEqual(
+            os.path.basename(os.readlink(storage_path)),
+            hashlib.sha256(b'hello').hexdigest(),
+        )
+        self.assertEqual(storage.logical_size('hello.txt'), 5)
+
+    @unittest.skipIf(zstandard is None, 'zstandard is not installed')
+    def test_store_should_compress_blobs_with_zstd_if_requested(self):
+        storage = FileStorage(self.temp_dir, blob_codec='zstd')
+        data = BytesIO(b'hello')
+
+        storage.store('hello.txt', data, version=1)
+
+        storage_path = os.path.join(self.temp_dir, 'links', 'hello.txt')
+        self.assertEqual(blob_encoding(storage_path), 'zstd')
+        with open_blob(storage_path) as f:
+            self.assertEqual(f.read(), b'hello')
+        self.assertEqual(storage.logical_size('hello.txt'), 5)
+
+    def test_store_should_compress_large_files_correctly(self):
+        storage = FileStorage(self.temp_dir)
+        data = b''.join(b'%08d' % i for i in range(3 * 1024 * 1024))
+
+        storage.store('big.txt', BytesIO(data), version=1, size=len(data))
+
+        storage_path = os.path.join(self.temp_dir, 'links', 'big.txt')
+        with gzip.open(storage_path, 'rb') as f:
+            self.assertEqual(f.read(), data)
+        self.assertEqual(
+            os.path.basename(os.readlink(storage_path)),
+            hashlib.sha256(data).hexdigest(),
+        )
+        self.assertEqual(storage.logical_size('big.txt'), len(data))
+
+    def test_store_should_not_expand_incompressible_files(self):
+        storage = FileStorage(self.temp_dir)
+        data = os.urandom(256 * 1024)
+
+        storage.store('random.bin', BytesIO(data), version=1)
+
+        storage_path = os.path.join(self.temp_dir, 'links', 'random.bin')
+        with gzip.open(storage_path, 'rb') as f:
+            self.assertEqual(f.read(), data)
+        self.assertLess(os.path.getsize(storage_path), len(data) + 100)
+
     def test_store_should_reuse_blobs(self):
         storage = FileStorage(self.temp_dir)
         data = BytesIO(b'hello')
@@ -90,6 +193,48 @@ class FileStorageTest(unittest.TestCase):
 
         self.assertEqual(os.readlink(storage_path_a), os.readlink(storage_path_b))
 
+    def test_store_should_reuse_existing_blob_without_reading_data(self):
+        storage = FileStorage(self.temp_dir)
+        digest = hashlib.sha256(b'hello').hexdigest()
+
+        with self.assertRaises(FiletrackerBlobNotFoundError):
+            storage.store(
+                'hello.txt',
+                None,
+                version=1,
+                digest=digest,
+                logical_size=5,
+                existing_blob_only=True,
+            )
+        self.assertIsNone(storage.stored_version('hello.txt'))
+
+        storage.store('world.txt', BytesIO(b'hello'), version=1)
+        storage.store(
+            'hello.txt',
+            None,
+            version=1,
+            digest=digest,
+            logical_size=5,
+            existing_blob_only=True,
+        )
+
+        storage_path = os.path.join(self.temp_dir, 'links', 'hello.txt')
+        with gzip.open(storage_path, 'rb') as f:
+            self.assertEqual(f.read(), b'hello')
+
+    def test_store_should_write_hinted_uncompressed_file(self):
+        storage = FileStorage(self.temp_dir)
+        digest = hashlib.sha256(b'hello').hexdigest()
+
+        storage.store(
+            'hello.txt', BytesIO(b'hello'), version=1, digest=digest, logical_size=5
+        )
+
+        storage_path = os.path.join(self.temp_dir, 'links', 'hello.txt')
+        with gzip.open(storage_path, 'rb') as f:
+            self.assertEqual(f.read(), b'hello')
+        self.assertEqual(storage.logical_size('hello.txt'), 5)
+
     def test_store_should_set_modified_time_to_version(self):
         storage = FileStorage(self.temp_dir)
         data = BytesIO(b'hello')
@@ -113,6 +258,18 @@ class FileStorageTest(unittest.TestCase):
         with gzip.open(storage_path, 'rb') as f:
             self.assertEqual(f.read(), b'world')
 
+    def test_store_should_only_update_version_of_same_contents(self):
+        storage = FileStorage(self.temp_dir)
+        digest = hashlib.sha256(b'hello').hexdigest()
+
+        storage.store('hello.txt', BytesIO(b'hello'), version=1)
+        storage.store('hello.txt', BytesIO(b'hello'), version=2)
+
+        self.assertEqual(storage.stored_version('hello.txt'), 2)
+        self.assertEqual(storage._blob_metadata(digest.encode()), (1, 5))
+        storage_path = os.path.join(self.temp_dir, 'links', 'hello.txt')
+        self.assertEqual(os.lstat(storage_path).st_mtime, 2)
+
     def test_store_should_not_overwrite_newer_files(self):
         storage = FileStorage(self.temp_dir)
         old_data = BytesIO(b'hello')
@@ -152,6 +309,94 @@ class FileStorageTest(unittest.TestCase):
         for _, _, files in os.walk(storage.blobs_dir):
             self.assertEqual(len(files), 0)
 
+    def test_open_range_should_return_part_of_contents(self):
+        storage = FileStorage(self.temp_dir)
+        storage.store('hello.txt', BytesIO(b'hello world'), version=1)
+
+        with storage.open_range('hello.txt', 6, 11) as f:
+            self.assertEqual(f.read(), b'world')
+        with storage.open_range('hello.txt', 2, 4) as f:
+            self.assertEqual(f.read(1), b'l')
+            self.assertEqual(f.read(), b'l')
+        # Small blobs are not indexed.
+        self.assertFalse(os.path.exists(storage.indexes_dir))
+
+    @unittest.skipIf(indexed_gzip is None, 'indexed_gzip is not installed')
+    def test_store_should_index_large_blobs(self):
+        storage = FileStorage(self.temp_dir)
+        data = b''.join(b'%08d' % i for i in range(3 * 1024 * 1024))
+        storage.store('big.txt', BytesIO(data), version=1)
+
+        def index_files():
+            return [f for _, _, files in os.walk(storage.indexes_dir) for f in files]
+
+        self.assertEqual(len(index_files()), 1)
+        with storage.open_range('big.txt', 20000000, 20000016) as f:
+            self.assertEqual(f.read(), data[20000000:20000016])
+
+        storage.delete('big.txt', version=1)
+        self.assertEqual(index_files(), [])
+        self.assertEqual(os.listdir(storage.temp_dir), [])
+
+    def test_storage_should_understand_old_metadata_format(self):
+        storage = FileStorage(self.temp_dir)
+        storage.store('hello.txt', BytesIO(b'hello'), version=1)
+        digest = hashlib.sha256(b'hello').hexdigest().encode()
+        storage.db.put(digest, b'1')
+        storage.db.put(digest + b':logical_size', b'5')
+
+        self.assertEqual(storage.logical_size('hello.txt'), 5)
+        storage.store('world.txt', BytesIO(b'hello'), version=1)
+        self.assertEqual(storage.db.get(digest), pack_blob_metadata(2, 5))
+
+        storage.delete('hello.txt', version=1)
+        storage.delete('world.txt', version=1)
+        self.assertIsNone(storage.db.get(digest))
+        self.assertIsNone(storage.db.get(digest + b':logical_size'))
+
+    def test_link_metadata_should_be_kept_in_db(self):
+        storage = FileStorage(self.temp_dir)
+        storage.store('hello.txt', BytesIO(b'hello'), version=1)
+        digest = hashlib.sha256(b'hello').hexdigest()
+
+        self.assertEqual(
+            storage.db.get(b'hello.txt:version'), '1 {} 5'.format(digest).encode()
+        )
+        self.assertEqual(storage.stored_version_and_size('hello.txt'), (1, 5))
+
+        # Values without digests still work, the link is read instead.
+        storage.db.put(b'hello.txt:version', b'1')
+        self.assertEqual(storage.stored_version_and_size('hello.txt'), (1, 5))
+        self.assertTrue(storage.delete('hello.txt', version=1))
+        self.assertEqual(storage.stored_version_and_size('hello.txt'), (None, None))
+
+    def test_failed_link_creation_should_not_change_db(self):
+        storage = FileStorage(self.temp_dir)
+        storage.store('hello', BytesIO(b'hello'), version=1)
+
+        # 'hello' is a file, so it can't be a directory for the link.
+        with self.assertRaises(OSError):
+            storage.store('hello/world.txt', BytesIO(b'world'), version=1)
+
+        self.assertIsNone(storage.stored_version('hello/world.txt'))
+        self.assertIsNone(
+            storage.db.get(hashlib.sha256(b'world').digest().hex().encode())
+        )
+
+    def test_overwriting_should_keep_link_and_db_in_sync(self):
+        storage = FileStorage(self.temp_dir)
+        storage.store('hello.txt', BytesIO(b'hello'), version=1)
+        storage.store('hello.txt', BytesIO(b'world'), version=2)
+
+        link_path = os.path.join(self.temp_dir, 'links', 'hello.txt')
+        self.assertEqual(os.lstat(link_path).st_mtime, 2)
+        self.assertEqual(storage.stored_version_and_size('hello.txt'), (2, 5))
+        with gzip.open(link_path, 'rb') as f:
+            self.assertEqual(f.read(), b'world')
+        # The replaced blob lost its only link.
+        self.assertIsNone(storage.db.get(hashlib.sha256(b'hello').hexdigest().encode()))
+        self.assertEqual(os.listdir(storage.temp_dir), [])
+
     def test_deleting_older_version_should_have_no_effect(self):
         storage = FileStorage(self.temp_dir)
 
@@ -170,3 +415,74 @@ class FileStorageTest(unittest.TestCase):
         storage.store('world.txt', data, version=2)
         self.assertEqual(storage.stored_version('hello.txt'), 1)
         self.assertEqual(storage.stored_version('world.txt'), 2)
+
+    def test_checkpoint_should_keep_stored_files(self):
+        storage = FileStorage(self.temp_dir, db_nosync=True)
+        storage.store('hello.txt', BytesIO(b'hello'), version=1)
+
+        storage.checkpoint()
+
+        self.assertEqual(storage.stored_version('hello.txt'), 1)
+        self.assertEqual(storage.logical_size('hello.txt'), 5)
+
+    def test_locks_should_exclude_each_other(self):
+        storage = FileStorage(self.temp_dir)
+        offset = _lock_offset('links', 'hello.txt')
+
+        with storage.locks.exclusive('links', 'hello.txt'):
+            self.assertFalse(storage.locks._try_lock(offset))
+
+            # Child processes are excluded by the fcntl lock itself.
+            pid = os.fork()
+            if pid == 0:
+                storage.locks._held.clear()
+                locked = storage.locks._try_lock(offset)
+                os._exit(1 if locked else 0)
+            _, status = os.waitpid(pid, 0)
+            self.assertEqual(os.WEXITSTATUS(status), 0)
+
+            with storage.locks.exclusive('blobs', 'hello.txt'):
+                pass
+
+        self.assertTrue(storage.locks._try_lock(offset))
+
+    def test_lock_should_be_handed_over_to_waiting_greenlet(self):
+        storage = FileStorage(self.temp_dir)
+        order = []
+
+        def hold():
+            with storage.locks.exclusive('links', 'hello.txt'):
+                order.append('first')
+                gevent.sleep(0.01)
+
+        def wait():
+            with storage.locks.exclusive('links', 'hello.txt'):
+                order.append('second')
+
+        start = time.time()
+        gevent.joinall([gevent.spawn(hold), gevent.spawn(wait)])
+
+        self.assertEqual(order, ['first', 'second'])
+        # Woken up on release, not after a lock polling interval.
+        self.assertLess(time.time() - start, 0.5)
+
+    def test_storages_in_one_process_should_share_locks(self):
+        first = FileStorage(self.temp_dir)
+        second = FileStorage(self.temp_dir)
+        offset = _lock_offset('links', 'hello.txt')
+
+        with first.locks.exclusive('links', 'hello.txt'):
+            self.assertFalse(second.locks._try_lock(offset))
+
+            # Closing a storage doesn't drop the locks of the others.
+            third = FileStorage(self.temp_dir)
+            del third
+            pid = os.fork()
+            if pid == 0:
+                first.locks._held.clear()
+                locked = first.locks._try_lock(offset)
+                os._exit(1 if locked else 0)
+            _, status = os.waitpid(pid, 0)
+            self.assertEqual(os.WEXITSTATUS(status), 0)
+
+        self.assertTrue(second.locks._try_lock(offset))
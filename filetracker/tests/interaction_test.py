@@ -111,6 +111,21 @@ class InteractionTest(unittest.TestCase):
         with open(src_file, 'rb') as sf:
             self.assertEqual(sf.read(), f.read())
 
+    def test_put_of_stored_contents_should_reuse_blob(self):
+        src_file = os.path.join(self.temp_dir, 'reused.txt')
+        with open(src_file, 'wb') as sf:
+            sf.write(b'reused' * 64 * 1024)
+
+        self.client.put_file('/reused_a.txt', src_file, to_local_store=False)
+        self.client.put_file('/reused_b.txt', src_file, to_local_store=False)
+
+        link_a = os.path.join(self.server_dir, 'links', 'reused_a.txt')
+        link_b = os.path.join(self.server_dir, 'links', 'reused_b.txt')
+        self.assertEqual(os.readlink(link_a), os.readlink(link_b))
+
+        f, _ = self.client.get_stream('/reused_b.txt')
+        self.assertEqual(f.read(), b'reused' * 64 * 1024)
+
     def test_file_version_should_be_set_to_current_time_on_upload(self):
         src_file = os.path.join(self.temp_dir, 'version.txt')
         with open(src_file, 'wb') as sf:
@@ -5,6 +5,7 @@ from __future__ import division
 from __future__ import print_function
 
 from multiprocessing import Process
+import hashlib
 import os
 import shutil
 import tempfile
@@ -14,6 +15,11 @@ import unittest
 import requests
 import six
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 from filetracker.client import Client
 from filetracker.servers.run import main as server_main
 
@@ -88,8 +94,137 @@ class ProtocolTest(unittest.TestCase):
         ]
         six.assertCountEqual(self, lines, expected)
 
+    def test_get_of_directory_should_return_404(self):
+        src_file = os.path.join(self.temp_dir, 'get_dir.txt')
+        with open(src_file, 'wb') as sf:
+            sf.write(b'hello dir')
+        self.client.put_file('/get_dir/a.txt', src_file)
+
+        res = requests.get(
+            'http://127.0.0.1:{}/files/get_dir'.format(_TEST_PORT_NUMBER)
+        )
+        self.assertEqual(res.status_code, 404)
+
+    def test_put_with_existing_blob_only_should_reuse_blobs(self):
+        src_file = os.path.join(self.temp_dir, 'reuse.txt')
+        with open(src_file, 'wb') as sf:
+            sf.write(b'hello reuse')
+        headers = {
+            'SHA256-Checksum': hashlib.sha256(b'hello reuse').hexdigest(),
+            'Logical-Size': '11',
+            'Only-If-Blob-Exists': 'true',
+        }
+        url = 'http://127.0.0.1:{}/files/reuse_b.txt?last_modified={}'.format(
+            _TEST_PORT_NUMBER, 'Thu, 01 Jan 2015 00:00:00 -0000'
+        )
+
+        res = requests.put(url, data=b'', headers=headers)
+        self.assertEqual(res.status_code, 412)
+
+        self.client.put_file('/reuse_a.txt', src_file)
+        res = requests.put(url, data=b'', headers=headers)
+        self.assertEqual(res.status_code, 200)
+
+        res = requests.get(
+            'http://127.0.0.1:{}/files/reuse_b.txt'.format(_TEST_PORT_NUMBER)
+        )
+        self.assertEqual(res.content, b'hello reuse')
+
+    def test_get_with_range_should_return_part_of_file(self):
+        src_file = os.path.join(self.temp_dir, 'range.txt')
+        with open(src_file, 'wb') as sf:
+            sf.write(b'hello range')
+        self.client.put_file('/range.txt', src_file)
+        url = 'http://127.0.0.1:{}/files/range.txt'.format(_TEST_PORT_NUMBER)
+
+        res = requests.get(url, headers={'Range': 'bytes=6-9'})
+        self.assertEqual(res.status_code, 206)
+        self.assertEqual(res.headers['Content-Range'], 'bytes 6-9/11')
+        self.assertNotIn('Content-Encoding', res.headers)
+        self.assertEqual(res.content, b'rang')
+
+        res = requests.get(url, headers={'Range': 'bytes=-5'})
+        self.assertEqual(res.status_code, 206)
+        self.assertEqual(res.content, b'range')
+
+        res = requests.get(url, headers={'Range': 'bytes=6-100'})
+        self.assertEqual(res.status_code, 206)
+        self.assertEqual(res.content, b'range')
+
+        res = requests.get(url, headers={'Range': 'bytes=11-'})
+        self.assertEqual(res.status_code, 416)
+        self.assertEqual(res.headers['Content-Range'], 'bytes */11')
+
+        # Multiple ranges are not supported, so the whole file is sent.
+        res = requests.get(url, headers={'Range': 'bytes=0-1,3-4'})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.content, b'hello range')
+
+
+_ZSTD_TEST_PORT_NUMBER = 45776
+
+
+@unittest.skipIf(zstandard is None, 'zstandard is not installed')
+class ZstdProtocolTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.cache_dir = tempfile.mkdtemp()
+        cls.server_dir = tempfile.mkdtemp()
+        cls.temp_dir = tempfile.mkdtemp()
+
+        cls.server_process = Process(
+            target=_start_server,
+            args=(cls.server_dir, _ZSTD_TEST_PORT_NUMBER, ['--blob-codec', 'zstd']),
+        )
+        cls.server_process.start()
+        time.sleep(2)  # give server some time to start
+
+        cls.client = Client(
+            cache_dir=cls.cache_dir,
+            remote_url='http://127.0.0.1:{}'.format(_ZSTD_TEST_PORT_NUMBER),
+        )
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server_process.terminate()
+        shutil.rmtree(cls.cache_dir)
+        shutil.rmtree(cls.server_dir)
+        shutil.rmtree(cls.temp_dir)
+
+    def setUp(self):
+        src_file = os.path.join(self.temp_dir, 'zstd.txt')
+        with open(src_file, 'wb') as sf:
+            sf.write(b'hello zstd')
+        # Uncompressed uploads are compressed by the server, with zstd.
+        self.client.put_file('/zstd.txt', src_file, compress_hint=False)
+        self.url = 'http://127.0.0.1:{}/files/zstd.txt'.format(_ZSTD_TEST_PORT_NUMBER)
+
+    def test_get_should_decompress_zstd_if_not_accepted(self):
+        res = requests.get(self.url, headers={'Accept-Encoding': 'gzip, deflate'})
+        self.assertEqual(res.status_code, 200)
+        self.assertNotIn('Content-Encoding', res.headers)
+        self.assertEqual(res.headers['Content-Length'], '10')
+        self.assertEqual(res.content, b'hello zstd')
+
+    def test_get_should_return_zstd_if_accepted(self):
+        res = requests.get(self.url, headers={'Accept-Encoding': 'zstd'}, stream=True)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['Content-Encoding'], 'zstd')
+        raw = res.raw.read(decode_content=False)
+        self.assertEqual(
+            zstandard.ZstdDecompressor().decompressobj().decompress(raw),
+            b'hello zstd',
+        )
+
+    def test_client_should_read_zstd_blobs(self):
+        dest_file = os.path.join(self.temp_dir, 'zstd_dest.txt')
+        self.client.get_file('/zstd.txt', dest_file, add_to_cache=False)
+        with open(dest_file, 'rb') as df:
+            self.assertEqual(df.read(), b'hello zstd')
+        self.assertEqual(self.client.file_size('/zstd.txt'), 10)
+
 
-def _start_server(server_dir):
+def _start_server(server_dir, port=_TEST_PORT_NUMBER, args=()):
     server_main(
-        ['-p', str(_TEST_PORT_NUMBER), '-d', server_dir, '-D', '--workers', '4']
+        ['-p', str(port), '-d', server_dir, '-D', '--workers', '4'] + list(args)
     )
@@ -4,11 +4,9 @@ import errno
 import hashlib
 import os
 import os.path
+import re
 import shutil
 
-import six
-from six import __init__
-
 
 def split_name(name):
     """Splits a (possibly versioned) name into unversioned name and version.
@@ -33,11 +31,25 @@ def versioned_name(unversioned_name, version):
 
     Returns a versioned path.
     """
-    return unversioned_name + '@' + str(version)
+    return '%s@%s' % (unversioned_name, version)
+
+
+# Matches names that pass all checks of check_name(), apart from versions
+# being allowed. One match is much cheaper than the checks themselves,
+# which are then only needed to tell why a name is invalid.
+_VALID_NAME_RE = re.compile(
+    r'(?!(?:.*/)?\.\.(?:/|\Z))/(?:[^/@]*/)*[^/@]*(?:@[^/@]*)?\Z', re.DOTALL
+)
 
 
 def check_name(name, allow_version=True):
-    if not isinstance(name, six.string_types):
+    if (
+        isinstance(name, str)
+        and _VALID_NAME_RE.match(name)
+        and (allow_version or '@' not in name)
+    ):
+        return
+    if not isinstance(name, str):
         raise ValueError("Invalid Filetracker filename: not string: %r" % (name,))
     parts = name.split('/')
     if not parts:
@@ -46,9 +58,9 @@ def check_name(name, allow_version=True):
         raise ValueError("Invalid Filetracker filename: does not start with /")
     if '..' in parts:
         raise ValueError("Invalid Filetracker filename: .. in path")
-    if '@' in ''.join(parts[:-1]):
+    if any('@' in part for part in parts[:-1]):
         raise ValueError("Invalid Filetracker filename: @ in path")
-    if len(parts[-1].split('@')) > 2:
+    if parts[-1].count('@') > 1:
         raise ValueError("Invalid Filetracker filename: multiple versions")
     if '@' in parts[-1] and not allow_version:
         raise ValueError(
@@ -57,11 +69,7 @@ def check_name(name, allow_version=True):
 
 
 def mkdir(name):
-    try:
-        os.makedirs(name, 0o700)
-    except OSError as e:
-        if e.errno != errno.EEXIST:
-            raise
+    os.makedirs(name, 0o700, exist_ok=True)
 
 
 def rmdirs(name, root):
@@ -77,27 +85,69 @@ def rmdirs(name, root):
                 raise
 
 
-_BUFFER_SIZE = 64 * 1024
+def fadvise(f, advice):
+    """Tells the kernel how the whole file ``f`` is going to be accessed.
+
+    ``advice`` is a name of ``POSIX_FADV_*`` constant without the prefix,
+    e.g. 'SEQUENTIAL'. Does nothing on platforms without posix_fadvise().
+    """
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(f.fileno(), 0, 0, getattr(os, 'POSIX_FADV_' + advice))
+
 
+# Large enough for the interpreter overhead of every read and update()
+# to be negligible compared to decompressing and hashing the data.
+_BUFFER_SIZE = 1024 * 1024
 
-def file_digest(source):
+
+def file_digest(source, return_size=False):
     """Calculates SHA256 digest of a file.
 
     Args:
         source: either a file-like object or a path to file
+        return_size: if set, a tuple ``(digest, size)`` is returned,
+            with the number of bytes read from ``source``
     """
     hash_sha256 = hashlib.sha256()
 
-    should_close = False
+    if isinstance(source, str):
+        with open(source, 'rb') as f:
+            # Files are never memory-mapped: they may be truncated while
+            # being hashed, and reading such a mapping raises SIGBUS.
+            size = _hash_stream(f, hash_sha256)
+    else:
+        size = _hash_stream(source, hash_sha256)
+
+    if return_size:
+        return hash_sha256.hexdigest(), size
+    return hash_sha256.hexdigest()
 
-    if isinstance(source, six.string_types):
-        should_close = True
-        source = open(source, 'rb')
 
-    for chunk in iter(lambda: source.read(_BUFFER_SIZE), b''):
-        hash_sha256.update(chunk)
+def _hash_stream(source, hash_sha256):
+    size = 0
+    if hasattr(source, 'readinto'):
+        # Reuses a single buffer instead of allocating one for every chunk.
+        buf = memoryview(bytearray(_BUFFER_SIZE))
+        for read_size in iter(lambda: source.readinto(buf), 0):
+            hash_sha256.update(buf[:read_size])
+            size += read_size
+    else:
+        for chunk in iter(lambda: source.read(_BUFFER_SIZE), b''):
+            hash_sha256.update(chunk)
+            size += len(chunk)
+    return size
 
-    if should_close:
-        source.close()
 
+def digest_and_copy(src, dst):
+    """Copies file-like ``src`` to ``dst``, calculating its SHA256 digest.
+
+    Equivalent to ``file_digest(src)`` followed by
+    ``shutil.copyfileobj(src, dst)``, but reads the data only once.
+    """
+    hash_sha256 = hashlib.sha256()
+    buf = memoryview(bytearray(_BUFFER_SIZE))
+    for read_size in iter(lambda: src.readinto(buf), 0):
+        chunk = buf[:read_size]
+        dst.write(chunk)
+        hash_sha256.update(chunk)
     return hash_sha256.hexdigest()